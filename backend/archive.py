@@ -0,0 +1,134 @@
+"""
+Архив жильцов: перенос удалённых и давно неактивных из горячих таблиц.
+
+users и status_events остаются небольшими, а архивные записи хранятся
+в users_archive / status_events_archive и могут быть восстановлены.
+
+Запуск архивации вручную или по cron:
+    python archive.py --days 90 --batch 500
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, literal, select
+from sqlalchemy.orm import Session
+
+from models import User, StatusEvent, ArchivedUser, ArchivedStatusEvent
+import queries
+import sync
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+
+
+def archive_users(db: Session, user_ids: list[int], reason: str) -> list[int]:
+    """
+    Перенос жильцов и их истории в архив (без коммита).
+
+    Возвращает id созданных архивных записей.
+    """
+    if not user_ids:
+        return []
+    now = datetime.utcnow()
+
+    archive_ids = db.execute(
+        insert(ArchivedUser).from_select(
+            ["user_id", "uuid", "full_name", "status", "last_update", "latitude", "longitude", "archived_at", "reason"],
+            select(
+                User.id, User.uuid, User.full_name, User.status, User.last_update,
+                User.latitude, User.longitude,
+                literal(now, ArchivedUser.archived_at.type),
+                literal(reason, ArchivedUser.reason.type),
+            ).where(User.id.in_(user_ids))
+        ).returning(ArchivedUser.id)
+    ).scalars().all()
+
+    db.execute(insert(ArchivedStatusEvent).from_select(
+        ["archive_id", "old_status", "new_status", "created_at"], queries.user_history(archive_ids)
+    ))
+    # Клиенты /api/sync удалят этих жильцов из своих зеркал
+    sync.add_tombstones(db, user_ids, sync.next_revision(db))
+    db.execute(delete(StatusEvent).where(StatusEvent.user_id.in_(user_ids)))
+    db.execute(delete(User).where(User.id.in_(user_ids)))
+    return archive_ids
+
+
+def archive_inactive(db: Session, days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Архивация жильцов без собственных отметок дольше days дней.
+
+    Работает пачками по batch_size с коммитом после каждой, чтобы
+    не держать блокировку записи SQLite надолго. Заодно удаляет устаревшие
+    надгробия синхронизации. Возвращает число перенесённых.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = 0
+    while True:
+        user_ids = db.execute(queries.inactive_users(cutoff, batch_size)).scalars().all()
+        if not user_ids:
+            sync.prune_tombstones(db)
+            db.commit()
+            return moved
+        archive_users(db, user_ids, reason="inactive")
+        db.commit()
+        moved += len(user_ids)
+
+
+def restore_user(db: Session, archive_id: int):
+    """
+    Возврат жильца из архива вместе с историей (без коммита).
+
+    Прежний id сохраняется, если он не занят; иначе выдаётся новый.
+    last_update ставится на момент восстановления — иначе архивация
+    по неактивности сразу вернула бы жильца в архив.
+    Возвращает восстановленного User или None, если записи в архиве нет.
+    """
+    archived = db.get(ArchivedUser, archive_id)
+    if archived is None:
+        return None
+
+    rev = sync.next_revision(db)
+    user = User(
+        id=archived.user_id if db.get(User, archived.user_id) is None else None,
+        uuid=archived.uuid,
+        full_name=archived.full_name,
+        status=archived.status,
+        last_update=datetime.utcnow(),
+        latitude=archived.latitude,
+        longitude=archived.longitude,
+        rev=rev,
+        created_rev=rev,
+    )
+    db.add(user)
+    db.flush()
+
+    db.execute(insert(StatusEvent).from_select(
+        ["user_id", "old_status", "new_status", "created_at"], queries.archived_history(archive_id, user.id)
+    ))
+    db.execute(delete(ArchivedStatusEvent).where(ArchivedStatusEvent.archive_id == archive_id))
+    db.delete(archived)
+    return user
+
+
+def main() -> None:
+    """Запуск архивации из командной строки."""
+    from database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Архивация неактивных жильцов")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="дней без отметок")
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH_SIZE, help="размер пачки")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        moved = archive_inactive(db, days=args.days, batch_size=args.batch)
+    finally:
+        db.close()
+    print(f"Перенесено в архив: {moved}")
+
+
+if __name__ == "__main__":
+    main()
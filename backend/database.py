@@ -1,9 +1,18 @@
+import os
+from contextlib import contextmanager
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-DATABASE_URL = "sqlite:///./users.db"
+try:
+    import fcntl
+except ImportError:  # Windows: там запускается один процесс, блокировка не нужна
+    fcntl = None
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./users.db")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# timeout — сколько воркер ждёт освобождения блокировки записи SQLite
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 15})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -16,3 +25,29 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+@contextmanager
+def setup_lock():
+    """Файловая блокировка рядом с БД: настройку схемы выполняет один процесс за раз."""
+    database = engine.url.database
+    if fcntl is None or not database or database == ":memory:":
+        yield
+        return
+    with open(f"{database}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def init_db():
+    """Миграции схемы и включение WAL (безопасно при одновременном старте воркеров)."""
+    import migrations
+
+    with setup_lock():
+        migrations.upgrade(engine)
+        with engine.connect() as conn:
+            # WAL: чтение не блокируется записью из другого воркера
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
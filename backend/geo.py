@@ -0,0 +1,220 @@
+"""
+Геозоны и пространственные запросы по последним координатам жильцов.
+
+Все вычисления векторизованы на NumPy: координаты хранятся в массивах,
+расстояния считаются формулой гаверсинуса сразу для всех точек.
+"""
+
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import UserStatus
+import queries
+import sync
+
+EARTH_RADIUS_M = 6_371_000.0
+METERS_PER_DEGREE = 111_320.0
+
+# Коды статусов для компактных массивов (порядок как в UserStatus)
+STATUS_CODES = {status: code for code, status in enumerate(UserStatus)}
+STATUSES = list(UserStatus)
+
+GEOFENCES_FILE = Path(os.getenv("GEOFENCES_FILE", Path(__file__).parent / "geofences.json"))
+
+
+# === Геозоны ===
+
+@dataclass(frozen=True)
+class Geofence:
+    """Круглая геозона: центр, радиус и статусы, допустимые внутри неё."""
+    name: str
+    latitude: float
+    longitude: float
+    radius_m: float
+    statuses: tuple = ("inside",)
+
+
+def load_geofences(path: Path = None) -> list[Geofence]:
+    """
+    Загрузка геозон из JSON-файла (если файла нет — геозон нет).
+
+    Неизвестный статус в файле — ValueError сразу при загрузке,
+    чтобы опечатка в конфигурации не всплывала ошибками в запросах.
+    """
+    path = Path(path or GEOFENCES_FILE)
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    fences = []
+    for item in raw:
+        statuses = tuple(item.get("statuses", ["inside"]))
+        unknown = [s for s in statuses if s not in {v.value for v in STATUSES}]
+        if unknown:
+            raise ValueError(
+                f"{path}: геозона '{item['name']}' — неизвестные статусы {unknown}, "
+                f"допустимы {[s.value for s in STATUSES]}"
+            )
+        fences.append(Geofence(
+            name=item["name"],
+            latitude=float(item["latitude"]),
+            longitude=float(item["longitude"]),
+            radius_m=float(item["radius_m"]),
+            statuses=statuses,
+        ))
+    return fences
+
+
+def haversine_m(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Расстояние в метрах между точками (поддерживает broadcasting массивов)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def find_mismatches(statuses: np.ndarray, lats: np.ndarray, lons: np.ndarray, fences: list[Geofence]):
+    """
+    Поиск жильцов, чей статус не соответствует последним координатам.
+
+    Статус считается ограниченным, если хотя бы одна геозона его перечисляет;
+    такой статус допустим только внутри одной из этих геозон. Координаты
+    сохраняются в момент смены статуса, поэтому зона здания обычно перечисляет
+    и статусы ухода — отметка «На работу» ставится ещё у двери.
+
+    Возвращает (индексы несоответствий, индекс ближайшей геозоны, расстояние до неё).
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if not fences or len(statuses) == 0:
+        return empty, empty, np.empty(0)
+
+    f_lats = np.array([f.latitude for f in fences])
+    f_lons = np.array([f.longitude for f in fences])
+    f_radii = np.array([f.radius_m for f in fences])
+
+    # Матрица (жильцы x геозоны)
+    dist = haversine_m(lats[:, None], lons[:, None], f_lats[None, :], f_lons[None, :])
+    within = dist <= f_radii[None, :]
+
+    # allowed[s, f] — статус s допустим в геозоне f
+    allowed = np.zeros((len(STATUSES), len(fences)), dtype=bool)
+    for j, fence in enumerate(fences):
+        for status in fence.statuses:
+            allowed[STATUS_CODES[UserStatus(status)], j] = True
+    constrained = allowed.any(axis=1)
+
+    ok = (within & allowed[statuses]).any(axis=1)
+    bad = np.flatnonzero(constrained[statuses] & ~ok)
+
+    nearest = dist[bad].argmin(axis=1) if len(bad) else empty
+    return bad, nearest, dist[bad, nearest]
+
+
+# === Сеточный индекс ===
+
+class GridIndex:
+    """
+    Сеточный индекс точек: ячейки фиксированного размера в градусах.
+
+    Ключи ячеек отсортированы, поэтому точки одной строки сетки
+    в диапазоне столбцов достаются одним searchsorted.
+    """
+
+    _COL_OFFSET = 1 << 20
+    _ROW_STRIDE = 1 << 21
+    MAX_CELLS = 4096
+
+    def __init__(self, lats: np.ndarray, lons: np.ndarray, cell_deg: float = 0.01):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_deg = cell_deg
+        keys = self._key(self._cell(self.lats), self._cell(self.lons))
+        self._order = np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+
+    def _cell(self, values):
+        return np.floor(np.asarray(values) / self.cell_deg).astype(np.int64)
+
+    def _key(self, rows, cols):
+        return rows * self._ROW_STRIDE + (cols + self._COL_OFFSET)
+
+    def _candidates(self, lat: float, lon: float, radius_m: float) -> np.ndarray:
+        """Индексы точек из ячеек, покрывающих окружность (или все точки)."""
+        dlat = radius_m / METERS_PER_DEGREE
+        cos_lat = np.cos(np.radians(min(abs(lat) + dlat, 90.0)))
+        dlon = radius_m / (METERS_PER_DEGREE * cos_lat) if cos_lat > 1e-6 else 360.0
+        if lon - dlon < -180 or lon + dlon > 180 or abs(lat) + dlat >= 90:
+            # Окружность пересекает полюс или 180-й меридиан — полный перебор
+            return np.arange(len(self.lats))
+
+        r0, r1 = self._cell(lat - dlat), self._cell(lat + dlat)
+        c0, c1 = self._cell(lon - dlon), self._cell(lon + dlon)
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > self.MAX_CELLS:
+            return np.arange(len(self.lats))
+
+        rows = np.arange(r0, r1 + 1)
+        starts = np.searchsorted(self._keys, self._key(rows, c0), side="left")
+        ends = np.searchsorted(self._keys, self._key(rows, c1), side="right")
+        parts = [self._order[s:e] for s, e in zip(starts, ends) if e > s]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def query(self, lat: float, lon: float, radius_m: float):
+        """Индексы точек в радиусе radius_m и расстояния до них."""
+        idx = self._candidates(lat, lon, radius_m)
+        dist = haversine_m(lat, lon, self.lats[idx], self.lons[idx])
+        mask = dist <= radius_m
+        return idx[mask], dist[mask]
+
+
+# === Снимок последних координат ===
+
+@dataclass
+class PositionSnapshot:
+    """Колоночный снимок жильцов с известными координатами."""
+    fingerprint: int
+    names: np.ndarray
+    statuses: np.ndarray
+    lats: np.ndarray
+    lons: np.ndarray
+    index: GridIndex = field(repr=False)
+
+
+_snapshot: PositionSnapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot(db: Session) -> PositionSnapshot:
+    """
+    Снимок координат, перестраиваемый только при изменении данных.
+
+    Признак изменения — ревизия синхронизации (sync.py): её увеличивает
+    каждая регистрация, смена статуса и координат, сброс и архивация.
+    """
+    global _snapshot
+    fingerprint = sync.current_revision(db)
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.fingerprint == fingerprint:
+        return snapshot
+
+    with _snapshot_lock:
+        if _snapshot is not None and _snapshot.fingerprint == fingerprint:
+            return _snapshot
+        rows = db.execute(queries.positions()).all()
+        lats = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+        lons = np.fromiter((r[3] for r in rows), dtype=np.float64, count=len(rows))
+        _snapshot = PositionSnapshot(
+            fingerprint=fingerprint,
+            names=np.array([r[0] for r in rows], dtype=object),
+            statuses=np.fromiter((STATUS_CODES[r[1]] for r in rows), dtype=np.int8, count=len(rows)),
+            lats=lats,
+            lons=lons,
+            index=GridIndex(lats, lons),
+        )
+        return _snapshot
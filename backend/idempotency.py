@@ -0,0 +1,102 @@
+"""
+Идемпотентность POST-запросов по заголовку Idempotency-Key.
+
+Ответ на первый запрос сохраняется в той же транзакции, что и сама запись,
+поэтому повтор с тем же ключом стоит одного поиска по первичному ключу
+и никогда не пишет дважды. Вместе с ответом хранится хеш тела запроса:
+тот же ключ с другим телом — ошибка 422, а не старый ответ. Старые ключи удаляются по TTL.
+"""
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import IdempotencyKey
+import queries
+
+IDEMPOTENCY_TTL = timedelta(hours=float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+MAX_KEY_LENGTH = 64
+# Как часто (в секундах) один процесс чистит просроченные ключи
+EVICT_INTERVAL = 60
+
+_last_evict = 0.0
+
+
+def validate_key(key: str) -> str:
+    """Проверка формата ключа."""
+    key = key.strip()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key: от 1 до {MAX_KEY_LENGTH} символов")
+    return key
+
+
+def body_hash(body: dict) -> str:
+    """SHA-256 тела запроса (ключи по порядку, чтобы не зависеть от сериализации клиента)."""
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def is_stored(db: Session, key: str) -> bool:
+    """Есть ли непросроченный ответ на ключ (без проверки эндпоинта и тела)."""
+    record = db.get(IdempotencyKey, key)
+    return record is not None and datetime.utcnow() - record.created_at <= IDEMPOTENCY_TTL
+
+
+def get_cached(db: Session, key: str, endpoint: str, request_hash: str):
+    """Сохранённый ответ для ключа или None, если запрос ещё не выполнялся."""
+    record = db.get(IdempotencyKey, key)
+    if record is None:
+        return None
+    if datetime.utcnow() - record.created_at > IDEMPOTENCY_TTL:
+        # Просроченный ключ ещё не вычищен — считаем его свободным
+        db.delete(record)
+        return None
+    # Ключи, сохранённые до появления хеша, сверяются только по эндпоинту
+    if record.endpoint != endpoint or record.request_hash not in (None, request_hash):
+        raise HTTPException(status_code=422, detail="Idempotency-Key уже использован для другого запроса")
+    return json.loads(record.response)
+
+
+def store(db: Session, key: str, endpoint: str, request_hash: str, response: dict) -> None:
+    """Добавить ответ в текущую транзакцию (коммитит вызывающий код)."""
+    _evict_expired(db)
+    db.add(IdempotencyKey(
+        key=key,
+        endpoint=endpoint,
+        request_hash=request_hash,
+        response=json.dumps(response, ensure_ascii=False),
+    ))
+
+
+def commit(db: Session, key: str, endpoint: str, request_hash: str):
+    """
+    Коммит записи вместе с ключом.
+
+    Если параллельный запрос с тем же ключом успел раньше — откатываемся
+    и возвращаем его ответ; иначе None.
+    """
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        cached = get_cached(db, key, endpoint, request_hash)
+        if cached is None:
+            raise
+        return cached
+    return None
+
+
+def _evict_expired(db: Session) -> None:
+    """Удаление просроченных ключей (не чаще раза в EVICT_INTERVAL секунд)."""
+    global _last_evict
+    now = time.monotonic()
+    if now - _last_evict < EVICT_INTERVAL:
+        return
+    _last_evict = now
+    cutoff = datetime.utcnow() - IDEMPOTENCY_TTL
+    db.execute(queries.expired_keys(cutoff))
@@ -1,31 +1,59 @@
+import time
+
+_import_started = time.perf_counter()
+
 import os
+import csv
+import signal
+import asyncio
+import io
 import logging
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
 
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse, Response
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import insert, literal, select, text
 from pydantic import BaseModel
 from typing import Optional
 
-from database import engine, get_db, Base
-from models import User, UserStatus
+import numpy as np
+
+from database import engine, get_db, init_db
+from models import User, UserStatus, StatusEvent
+import idempotency
+import queries
+import reports
+import archive
+import ratelimit
+import sync
+from geo import load_geofences, find_mismatches, get_snapshot, STATUSES
 
 # === Настройка логирования ===
 LOG_DIR = Path(__file__).parent / "logs"
-LOG_DIR.mkdir(exist_ok=True)
 LOG_FILE = LOG_DIR / "activity.log"
 
 # Логгер для активности пользователей
 activity_logger = logging.getLogger("activity")
 activity_logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
-file_handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
-activity_logger.addHandler(file_handler)
+
+# Служебный логгер (старт, остановка)
+logger = logging.getLogger("skud")
+logger.setLevel(logging.INFO)
+
+
+def setup_logging():
+    """Подключение файла активности (при старте процесса, а не при импорте)."""
+    if activity_logger.handlers:
+        return
+    LOG_DIR.mkdir(exist_ok=True)
+    file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+    activity_logger.addHandler(file_handler)
 
 
 def log_activity(user: User, old_status: str, new_status: str, lat: float = None, lon: float = None):
@@ -34,10 +62,62 @@ def log_activity(user: User, old_status: str, new_status: str, lat: float = None
     activity_logger.info(f"{user.full_name} | {old_status} -> {new_status}{location}")
 
 
-# Создание таблиц
-Base.metadata.create_all(bind=engine)
+# === Запуск и остановка ===
+
+# Время холодного старта процесса (секунды), отдаётся в /api/ready
+startup_timing = {"import": 0.0, "setup": 0.0}
+
+# Сколько секунд после SIGTERM воркер ещё принимает запросы, отвечая 503 на /api/ready,
+# чтобы балансировщик успел снять его с трафика
+SHUTDOWN_DELAY = float(os.getenv("SHUTDOWN_DELAY", "5"))
+
+
+def _install_sigterm_handler(app: FastAPI) -> None:
+    """
+    SIGTERM: сразу снять готовность, остановку начать через SHUTDOWN_DELAY.
+
+    Обработчик uvicorn на SIGTERM заменяется; по истечении задержки
+    процесс шлёт себе SIGINT, который uvicorn обрабатывает как обычную
+    плавную остановку (перестать слушать порт, дождаться текущих запросов).
+    """
+    loop = asyncio.get_running_loop()
 
-app = FastAPI(title="СКУД-лайт API", version="1.1.0")
+    def begin_shutdown():
+        if not app.state.ready:
+            return
+        app.state.ready = False
+        logger.info("Воркер %s: SIGTERM, остановка через %.0f с", os.getpid(), SHUTDOWN_DELAY)
+        loop.call_later(SHUTDOWN_DELAY, os.kill, os.getpid(), signal.SIGINT)
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, begin_shutdown)
+    except (NotImplementedError, RuntimeError):
+        # Windows или не главный поток — остаётся обработчик uvicorn
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Настройка при старте воркера; по SIGTERM — снятие готовности, затем остановка."""
+    started = time.perf_counter()
+    setup_logging()
+    init_db()
+    startup_timing["setup"] = time.perf_counter() - started
+    app.state.ready = True
+    _install_sigterm_handler(app)
+    logger.info(
+        "Воркер %s готов: импорт %.0f мс, настройка %.0f мс",
+        os.getpid(), startup_timing["import"] * 1000, startup_timing["setup"] * 1000,
+    )
+    yield
+    # Порт уже закрыт, текущие запросы завершены
+    app.state.ready = False
+    engine.dispose()
+    logger.info("Воркер %s остановлен", os.getpid())
+
+
+app = FastAPI(title="СКУД-лайт API", version="1.1.0", lifespan=lifespan)
+app.state.ready = False
 
 # Настройка CORS для работы с фронтендом
 app.add_middleware(
@@ -89,6 +169,17 @@ class AbsentUser(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
     has_location: bool = False
+    distance_m: Optional[float] = None
+
+
+class GeofenceMismatch(BaseModel):
+    full_name: str
+    status: str
+    status_label: str
+    latitude: float
+    longitude: float
+    nearest_fence: str
+    distance_m: float
 
 
 # === Маппинг статусов ===
@@ -100,33 +191,81 @@ STATUS_LABELS = {
     "request": "По заявлению",
 }
 
+# Геозоны (здание, места работы) — см. geofences.example.json
+GEOFENCES = load_geofences()
+
 
 # === API Endpoints ===
 
-@app.post("/api/register", response_model=RegisterResponse)
-def register_user(data: RegisterRequest, db: Session = Depends(get_db)):
-    """Регистрация нового жильца."""
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Счётчики ограничителя записи (формат Prometheus)."""
+    return ratelimit.metrics_text()
+
+
+@app.get("/api/ready")
+def readiness():
+    """Готовность принимать запросы: схема настроена и БД отвечает."""
+    if not app.state.ready:
+        return JSONResponse(status_code=503, content={"ready": False})
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception:
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {
+        "ready": True,
+        "pid": os.getpid(),
+        "startup_ms": {name: round(value * 1000, 1) for name, value in startup_timing.items()},
+    }
+
+
+@app.post("/api/register", response_model=RegisterResponse, dependencies=[Depends(ratelimit.write_guard)])
+def register_user(
+    data: RegisterRequest,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """Регистрация нового жильца (повтор с тем же Idempotency-Key не создаёт дубль)."""
     if not data.full_name or len(data.full_name.strip()) < 2:
         raise HTTPException(status_code=400, detail="Введите корректное ФИО")
+
+    endpoint = "POST /api/register"
+    if idempotency_key is not None:
+        idempotency_key = idempotency.validate_key(idempotency_key)
+        request_hash = idempotency.body_hash(data.model_dump())
+        cached = idempotency.get_cached(db, idempotency_key, endpoint, request_hash)
+        if cached is not None:
+            return cached
     
-    user = User(full_name=data.full_name.strip())
+    rev = sync.next_revision(db)
+    user = User(full_name=data.full_name.strip(), rev=rev, created_rev=rev)
     db.add(user)
-    db.commit()
-    db.refresh(user)
-    
-    log_activity(user, "NEW", user.status.value)
-    
-    return RegisterResponse(
+    db.flush()
+    db.add(StatusEvent(user_id=user.id, old_status=None, new_status=user.status))
+
+    response = RegisterResponse(
         user_id=user.uuid,
         full_name=user.full_name,
         status=user.status.value
     )
+    if idempotency_key is not None:
+        idempotency.store(db, idempotency_key, endpoint, request_hash, response.model_dump())
+        cached = idempotency.commit(db, idempotency_key, endpoint, request_hash)
+        if cached is not None:
+            return cached
+    else:
+        db.commit()
+    
+    log_activity(user, "NEW", user.status.value)
+    
+    return response
 
 
 @app.get("/api/status/{user_id}", response_model=UserStatusResponse)
 def get_status(user_id: str, db: Session = Depends(get_db)):
     """Получить статус пользователя по UUID."""
-    user = db.query(User).filter(User.uuid == user_id).first()
+    user = db.execute(queries.user_by_uuid(user_id)).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
@@ -138,10 +277,23 @@ def get_status(user_id: str, db: Session = Depends(get_db)):
     )
 
 
-@app.post("/api/status/{user_id}", response_model=UserStatusResponse)
-def update_status(user_id: str, data: StatusUpdate, db: Session = Depends(get_db)):
-    """Обновить статус пользователя."""
-    user = db.query(User).filter(User.uuid == user_id).first()
+@app.post("/api/status/{user_id}", response_model=UserStatusResponse, dependencies=[Depends(ratelimit.write_guard)])
+def update_status(
+    user_id: str,
+    data: StatusUpdate,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """Обновить статус пользователя (повтор с тем же Idempotency-Key не пишет дважды)."""
+    endpoint = f"POST /api/status/{user_id}"
+    if idempotency_key is not None:
+        idempotency_key = idempotency.validate_key(idempotency_key)
+        request_hash = idempotency.body_hash(data.model_dump())
+        cached = idempotency.get_cached(db, idempotency_key, endpoint, request_hash)
+        if cached is not None:
+            return cached
+
+    user = db.execute(queries.user_by_uuid(user_id)).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
@@ -153,32 +305,40 @@ def update_status(user_id: str, data: StatusUpdate, db: Session = Depends(get_db
     
     old_status = user.status.value
     user.status = new_status
+    user.rev = sync.next_revision(db)
     
     # Сохранение геолокации
     if data.latitude is not None and data.longitude is not None:
         user.latitude = data.latitude
         user.longitude = data.longitude
-    
-    db.commit()
-    db.refresh(user)
-    
-    # Логирование
-    log_activity(user, old_status, new_status.value, data.latitude, data.longitude)
-    
-    return UserStatusResponse(
+
+    db.add(StatusEvent(user_id=user.id, old_status=UserStatus(old_status), new_status=new_status))
+    db.flush()
+
+    response = UserStatusResponse(
         user_id=user.uuid,
         full_name=user.full_name,
         status=user.status.value,
         last_update=user.last_update.isoformat() if user.last_update else ""
     )
+    if idempotency_key is not None:
+        idempotency.store(db, idempotency_key, endpoint, request_hash, response.model_dump())
+        cached = idempotency.commit(db, idempotency_key, endpoint, request_hash)
+        if cached is not None:
+            return cached
+    else:
+        db.commit()
+    
+    # Логирование
+    log_activity(user, old_status, new_status.value, data.latitude, data.longitude)
+    
+    return response
 
 
 @app.get("/api/stats", response_model=StatsResponse)
 def get_stats(db: Session = Depends(get_db)):
     """Статистика по всем пользователям."""
-    stats = db.query(
-        User.status, func.count(User.id)
-    ).group_by(User.status).all()
+    stats = db.execute(queries.status_counts()).all()
     
     result = {"inside": 0, "work": 0, "day_off": 0, "request": 0}
     for status, count in stats:
@@ -196,9 +356,17 @@ def get_stats(db: Session = Depends(get_db)):
 
 
 @app.get("/api/absent", response_model=list[AbsentUser])
-def get_absent(db: Session = Depends(get_db)):
-    """Список отсутствующих (все кроме inside) с геолокацией."""
-    users = db.query(User).filter(User.status != UserStatus.inside).order_by(User.full_name).all()
+def get_absent(near: Optional[str] = None, radius: float = 1000, db: Session = Depends(get_db)):
+    """
+    Список отсутствующих (все кроме inside) с геолокацией.
+
+    С параметром near=lat,lon — только те, чьи последние координаты
+    в радиусе radius метров от точки (поиск по сеточному индексу).
+    """
+    if near is not None:
+        return _absent_near(near, radius, db)
+
+    users = db.execute(queries.absent_users()).scalars().all()
     
     return [
         AbsentUser(
@@ -213,19 +381,183 @@ def get_absent(db: Session = Depends(get_db)):
     ]
 
 
-@app.post("/api/reset")
+def _absent_near(near: str, radius: float, db: Session) -> list[AbsentUser]:
+    """Отсутствующие в радиусе от точки."""
+    try:
+        lat, lon = (float(x) for x in near.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный формат near: ожидается lat,lon")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or radius <= 0:
+        raise HTTPException(status_code=400, detail="Неверные координаты или радиус")
+
+    snapshot = get_snapshot(db)
+    idx, dist = snapshot.index.query(lat, lon, radius)
+    inside_code = STATUSES.index(UserStatus.inside)
+    mask = snapshot.statuses[idx] != inside_code
+    idx, dist = idx[mask], dist[mask]
+    order = np.argsort(snapshot.names[idx], kind="stable")
+
+    result = []
+    for i, d in zip(idx[order], dist[order]):
+        status = STATUSES[snapshot.statuses[i]].value
+        result.append(AbsentUser(
+            full_name=snapshot.names[i],
+            status=status,
+            status_label=STATUS_LABELS.get(status, status),
+            latitude=float(snapshot.lats[i]),
+            longitude=float(snapshot.lons[i]),
+            has_location=True,
+            distance_m=round(float(d), 1)
+        ))
+    return result
+
+
+@app.get("/api/geofences/mismatches", response_model=list[GeofenceMismatch])
+def get_geofence_mismatches(db: Session = Depends(get_db)):
+    """Жильцы, чей статус не совпадает с местом, где они отметились."""
+    snapshot = get_snapshot(db)
+    bad, nearest, dist = find_mismatches(snapshot.statuses, snapshot.lats, snapshot.lons, GEOFENCES)
+
+    result = []
+    for i, f, d in zip(bad, nearest, dist):
+        status = STATUSES[snapshot.statuses[i]].value
+        result.append(GeofenceMismatch(
+            full_name=snapshot.names[i],
+            status=status,
+            status_label=STATUS_LABELS.get(status, status),
+            latitude=float(snapshot.lats[i]),
+            longitude=float(snapshot.lons[i]),
+            nearest_fence=GEOFENCES[f].name,
+            distance_m=round(float(d), 1)
+        ))
+    result.sort(key=lambda m: m.full_name)
+    return result
+
+
+@app.post("/api/reset", dependencies=[Depends(ratelimit.write_guard)])
 def reset_all(db: Session = Depends(get_db)):
     """Сбросить всех пользователей в статус 'В здании'."""
-    db.query(User).update({User.status: UserStatus.inside})
+    # История: переход в inside для всех, кто не в здании
+    db.execute(insert(StatusEvent).from_select(
+        ["user_id", "old_status", "new_status", "created_at"],
+        select(
+            User.id,
+            User.status,
+            literal(UserStatus.inside, StatusEvent.new_status.type),
+            literal(datetime.utcnow(), StatusEvent.created_at.type),
+        ).where(User.status != UserStatus.inside)
+    ))
+    # last_update — время отметки самого жильца: сброс её не меняет,
+    # иначе архивация по неактивности никогда бы не срабатывала
+    db.query(User).filter(User.status != UserStatus.inside).update(
+        {User.status: UserStatus.inside, User.last_update: User.last_update, User.rev: sync.next_revision(db)}
+    )
     db.commit()
     activity_logger.info("ADMIN | Сброс всех статусов на 'inside'")
     return {"message": "Все статусы сброшены", "new_status": "inside"}
 
 
+@app.get("/api/sync")
+def get_sync(since: int = 0, db: Session = Depends(get_db)):
+    """
+    Изменения списка жильцов после ревизии since в MessagePack (формат — см. sync.py).
+
+    since=0 или слишком старая ревизия — полный снимок.
+    """
+    if since < 0:
+        raise HTTPException(status_code=400, detail="Ревизия не может быть отрицательной")
+    payload = sync.build_delta(db, since)
+    return Response(content=sync.pack(payload), media_type=sync.MEDIA_TYPE, headers={"X-Sync-Revision": str(payload["rev"])})
+
+
+# === Отчёты ===
+
+def _attendance(month: Optional[str], bucket: int, utc_offset: int, db: Session):
+    """Общий расчёт для JSON- и CSV-отчёта."""
+    month = month or (datetime.utcnow() + timedelta(hours=utc_offset)).strftime("%Y-%m")
+    try:
+        start, end = reports.month_period(month, utc_offset)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Месяц в формате YYYY-MM")
+    if not 60 <= bucket <= 86400 or not -12 <= utc_offset <= 14:
+        raise HTTPException(status_code=400, detail="Неверный интервал или смещение часового пояса")
+    return month, reports.attendance_report(db, start, end, bucket=bucket, utc_offset=utc_offset)
+
+
+@app.get("/api/reports/attendance")
+def get_attendance_report(
+    month: Optional[str] = None,
+    bucket: int = 3600,
+    utc_offset: int = 0,
+    db: Session = Depends(get_db),
+):
+    """
+    Отчёт о присутствии за месяц: часы по статусам для каждого жильца,
+    кривая отсутствия (интервалы по bucket секунд) и пиковые часы.
+    """
+    month, report = _attendance(month, bucket, utc_offset, db)
+    names = reports.user_names(db)
+    hours = np.round(report.seconds / 3600, 2)
+    absent_hours = np.round(report.absent_seconds / 3600, 2)
+
+    return {
+        "month": month,
+        "start": datetime.utcfromtimestamp(report.start).isoformat(),
+        "end": datetime.utcfromtimestamp(report.end).isoformat(),
+        "users": [
+            {
+                "id": user_id,
+                "full_name": names.get(user_id, ""),
+                "hours": dict(zip((s.value for s in reports.STATUSES), row)),
+                "absent_hours": absent,
+            }
+            for user_id, row, absent in zip(report.user_ids.tolist(), hours.tolist(), absent_hours.tolist())
+        ],
+        "curve": {
+            "bucket_seconds": bucket,
+            "bucket_starts": [datetime.utcfromtimestamp(t).isoformat() for t in report.bucket_starts.tolist()],
+            "avg_absent": np.round(report.avg_absent, 2).tolist(),
+        },
+        "by_hour": np.round(report.by_hour, 2).tolist(),
+        "peak": {
+            "absent": report.peak_absent,
+            "at": datetime.utcfromtimestamp(report.peak_at).isoformat(),
+        },
+    }
+
+
+@app.get("/api/reports/attendance.csv")
+def export_attendance_csv(month: Optional[str] = None, utc_offset: int = 0, db: Session = Depends(get_db)):
+    """Выгрузка часов по статусам в CSV (потоком)."""
+    month, report = _attendance(month, 3600, utc_offset, db)
+    names = reports.user_names(db)
+    hours = np.round(report.seconds / 3600, 2).tolist()
+    absent_hours = np.round(report.absent_seconds / 3600, 2).tolist()
+    user_ids = report.user_ids.tolist()
+
+    def rows(chunk: int = 1000):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "full_name", *(s.value for s in reports.STATUSES), "absent"])
+        for i in range(0, len(user_ids), chunk):
+            for j in range(i, min(i + chunk, len(user_ids))):
+                writer.writerow([user_ids[j], names.get(user_ids[j], ""), *hours[j], absent_hours[j]])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return StreamingResponse(
+        rows(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="attendance-{month}.csv"'},
+    )
+
+
 @app.get("/api/users")
 def get_all_users(db: Session = Depends(get_db)):
     """Получить список всех пользователей."""
-    users = db.query(User).order_by(User.full_name).all()
+    users = db.execute(queries.users_by_name()).scalars().all()
     return [
         {
             "id": u.id,
@@ -244,7 +576,7 @@ def search_users(q: str, db: Session = Depends(get_db)):
     if not q or len(q) < 2:
         raise HTTPException(status_code=400, detail="Минимум 2 символа для поиска")
     
-    users = db.query(User).filter(User.full_name.ilike(f"%{q}%")).order_by(User.full_name).limit(10).all()
+    users = db.execute(queries.search_users(q)).scalars().all()
     return [
         {
             "id": u.id,
@@ -257,19 +589,67 @@ def search_users(q: str, db: Session = Depends(get_db)):
     ]
 
 
-@app.delete("/api/users/{user_id}")
+@app.delete("/api/users/{user_id}", dependencies=[Depends(ratelimit.write_guard)])
 def delete_user(user_id: int, db: Session = Depends(get_db)):
-    """Удалить пользователя по ID."""
-    user = db.query(User).filter(User.id == user_id).first()
+    """Удалить пользователя по ID (переносится в архив вместе с историей)."""
+    user = db.execute(queries.user_by_id(user_id)).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
     full_name = user.full_name
-    db.delete(user)
+    archive_ids = archive.archive_users(db, [user.id], reason="deleted")
     db.commit()
     
     activity_logger.info(f"ADMIN | Удалён пользователь: {full_name}")
-    return {"message": f"Пользователь '{full_name}' удалён", "deleted_id": user_id}
+    return {
+        "message": f"Пользователь '{full_name}' удалён",
+        "deleted_id": user_id,
+        "archive_id": archive_ids[0],
+    }
+
+
+# === Архив ===
+
+@app.get("/api/archive/search")
+def search_archive(q: str, db: Session = Depends(get_db)):
+    """Поиск жильцов в архиве по ФИО."""
+    if not q or len(q) < 2:
+        raise HTTPException(status_code=400, detail="Минимум 2 символа для поиска")
+
+    users = db.execute(queries.search_archive(q)).scalars().all()
+    return [
+        {
+            "archive_id": u.id,
+            "uuid": u.uuid,
+            "full_name": u.full_name,
+            "reason": u.reason,
+            "archived_at": u.archived_at.isoformat() if u.archived_at else "",
+        }
+        for u in users
+    ]
+
+
+@app.post("/api/archive/run", dependencies=[Depends(ratelimit.write_guard)])
+def run_archive(days: int = archive.ARCHIVE_AFTER_DAYS, db: Session = Depends(get_db)):
+    """Перенести в архив жильцов без отметок дольше days дней."""
+    if days < 1:
+        raise HTTPException(status_code=400, detail="Минимум 1 день")
+
+    moved = archive.archive_inactive(db, days=days)
+    activity_logger.info(f"ADMIN | В архив перенесено неактивных (>{days} дн.): {moved}")
+    return {"message": f"Перенесено в архив: {moved}", "archived": moved}
+
+
+@app.post("/api/archive/{archive_id}/restore", dependencies=[Depends(ratelimit.write_guard)])
+def restore_from_archive(archive_id: int, db: Session = Depends(get_db)):
+    """Восстановить жильца из архива вместе с историей."""
+    user = archive.restore_user(db, archive_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="Запись в архиве не найдена")
+    db.commit()
+
+    activity_logger.info(f"ADMIN | Восстановлен из архива: {user.full_name}")
+    return {"message": f"Пользователь '{user.full_name}' восстановлен", "id": user.id, "uuid": user.uuid}
 
 
 # === Раздача статических файлов ===
@@ -300,6 +680,9 @@ def serve_static(filename: str):
     raise HTTPException(status_code=404, detail="Файл не найден")
 
 
+startup_timing["import"] = time.perf_counter() - _import_started
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
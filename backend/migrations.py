@@ -0,0 +1,313 @@
+"""
+Миграции схемы БД (вместо Base.metadata.create_all).
+
+Номер применённой миграции хранится в таблице schema_version; при старте
+применяются только новые. Миграция — список SQL-команд; базовая написана
+с IF NOT EXISTS, поэтому БД, созданные раньше через create_all, принимаются как есть.
+
+    python migrations.py                # применить миграции к DATABASE_URL
+    python migrations.py --check-plans  # проверить, что запросы эндпоинтов идут по индексам
+"""
+
+import argparse
+import logging
+import sys
+
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("skud")
+
+BASELINE = [
+    """CREATE TABLE IF NOT EXISTS users (
+        id INTEGER NOT NULL,
+        uuid VARCHAR,
+        full_name VARCHAR NOT NULL,
+        status VARCHAR(7),
+        last_update DATETIME,
+        latitude FLOAT,
+        longitude FLOAT,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_uuid ON users (uuid)",
+    "CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)",
+    """CREATE TABLE IF NOT EXISTS status_events (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        old_status VARCHAR(7),
+        new_status VARCHAR(7) NOT NULL,
+        created_at DATETIME,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_status_events_period ON status_events (created_at, user_id, new_status, old_status)",
+    "CREATE INDEX IF NOT EXISTS ix_status_events_user ON status_events (user_id, created_at)",
+    """CREATE TABLE IF NOT EXISTS users_archive (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        uuid VARCHAR NOT NULL,
+        full_name VARCHAR NOT NULL,
+        status VARCHAR(7),
+        last_update DATETIME,
+        latitude FLOAT,
+        longitude FLOAT,
+        archived_at DATETIME,
+        reason VARCHAR NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_users_archive_full_name ON users_archive (full_name)",
+    "CREATE INDEX IF NOT EXISTS ix_users_archive_uuid ON users_archive (uuid)",
+    """CREATE TABLE IF NOT EXISTS status_events_archive (
+        id INTEGER NOT NULL,
+        archive_id INTEGER NOT NULL,
+        old_status VARCHAR(7),
+        new_status VARCHAR(7) NOT NULL,
+        created_at DATETIME,
+        PRIMARY KEY (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_status_events_archive_archive_id ON status_events_archive (archive_id)",
+    """CREATE TABLE IF NOT EXISTS idempotency_keys (
+        "key" VARCHAR(64) NOT NULL,
+        endpoint VARCHAR NOT NULL,
+        response TEXT NOT NULL,
+        created_at DATETIME,
+        PRIMARY KEY ("key")
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at ON idempotency_keys (created_at)",
+]
+
+def add_column(table: str, column: str, definition: str):
+    """Шаг миграции ALTER TABLE ... ADD COLUMN, пропускаемый, если колонка уже есть."""
+    def step(cursor) -> None:
+        columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+# (номер, описание, шаги) — только добавлять в конец, не менять применённые.
+# Шаг — SQL-команда или функция от курсора; все шаги должны переживать повторный запуск.
+MIGRATIONS = [
+    (1, "Базовая схема", BASELINE),
+    (2, "Индексы под запросы эндпоинтов", [
+        # /api/stats (GROUP BY status)
+        "CREATE INDEX IF NOT EXISTS ix_users_status_full_name ON users (status, full_name)",
+        # /api/users и /api/users/search (ORDER BY full_name)
+        "CREATE INDEX IF NOT EXISTS ix_users_full_name ON users (full_name)",
+        # архивация неактивных (last_update < ?)
+        "CREATE INDEX IF NOT EXISTS ix_users_last_update ON users (last_update)",
+        # статистика для планировщика
+        "ANALYZE",
+    ]),
+    (3, "Ревизии для /api/sync", [
+        add_column("users", "rev", "INTEGER NOT NULL DEFAULT 0"),
+        add_column("users", "created_rev", "INTEGER NOT NULL DEFAULT 0"),
+        "CREATE INDEX IF NOT EXISTS ix_users_rev ON users (rev)",
+        """CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER NOT NULL,
+            revision INTEGER NOT NULL,
+            min_rev INTEGER NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        "INSERT OR IGNORE INTO sync_state (id, revision, min_rev) VALUES (1, 0, 0)",
+        """CREATE TABLE IF NOT EXISTS sync_tombstones (
+            id INTEGER NOT NULL,
+            rev INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at DATETIME,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_sync_tombstones_rev ON sync_tombstones (rev)",
+    ]),
+    (4, "Частичный индекс для /api/absent", [
+        # Только отсутствующие, по ФИО: список читается в порядке индекса, без сортировки
+        "CREATE INDEX IF NOT EXISTS ix_users_absent_full_name ON users (full_name) WHERE status != 'inside'",
+        "ANALYZE",
+    ]),
+    (5, "Хеш тела запроса для Idempotency-Key", [
+        add_column("idempotency_keys", "request_hash", "VARCHAR(64)"),
+    ]),
+]
+
+
+def current_version(engine: Engine) -> int:
+    """Номер последней применённой миграции (0 — новая БД)."""
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        return conn.exec_driver_sql("SELECT max(version) FROM schema_version").scalar() or 0
+
+
+def _apply(engine: Engine, number: int, steps: list) -> None:
+    """
+    Одна миграция в явной транзакции.
+
+    pysqlite сам открывает транзакцию только перед INSERT/UPDATE/DELETE,
+    а CREATE и ALTER без неё фиксируются сразу. Поэтому BEGIN/COMMIT
+    отправляются вручную: при ошибке откатываются все шаги и номер версии.
+    """
+    with engine.connect() as conn:
+        raw = conn.connection.driver_connection
+        isolation_level = raw.isolation_level
+        raw.isolation_level = None
+        cursor = raw.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (number,))
+            cursor.execute("COMMIT")
+        except BaseException:
+            if raw.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.close()
+            raw.isolation_level = isolation_level
+
+
+def upgrade(engine: Engine) -> list[int]:
+    """Применение новых миграций, каждая в своей транзакции. Возвращает их номера."""
+    version = current_version(engine)
+    applied = []
+    for number, description, steps in MIGRATIONS:
+        if number <= version:
+            continue
+        _apply(engine, number, steps)
+        logger.info("Миграция %s применена: %s", number, description)
+        applied.append(number)
+    return applied
+
+
+# === Проверка планов запросов ===
+
+# Запросы с ORDER BY, которые должны читаться в порядке индекса (без сортировки)
+ORDERED_BY_INDEX = {
+    "GET /api/absent",
+    "GET /api/users",
+    "GET /api/users/search",
+    "POST /api/archive/run",
+    "GET /api/archive/search",
+    "GET /api/reports/attendance (период)",
+}
+
+
+def endpoint_queries() -> dict:
+    """Запросы эндпоинтов, построенные теми же функциями, что и в коде (для EXPLAIN QUERY PLAN)."""
+    from datetime import datetime
+
+    import queries
+
+    now = datetime.utcnow()
+    return {
+        "GET/POST /api/status/{user_id}": queries.user_by_uuid("x"),
+        "GET /api/stats": queries.status_counts(),
+        "GET /api/absent": queries.absent_users(),
+        "GET /api/absent?near=, /api/geofences/mismatches": queries.positions(),
+        "GET /api/users": queries.users_by_name(),
+        "GET /api/users/search": queries.search_users("x"),
+        "DELETE /api/users/{user_id}": queries.user_by_id(1),
+        "DELETE /api/users/{user_id} (история в архив)": queries.user_history([1]),
+        "POST /api/archive/run": queries.inactive_users(now, 500),
+        "GET /api/archive/search": queries.search_archive("x"),
+        "POST /api/archive/{archive_id}/restore": queries.archived_history(1, 1),
+        "GET /api/reports/attendance (период)": queries.period_events(now, now),
+        "GET /api/reports/attendance (начальные статусы)": queries.initial_statuses(now),
+        "GET /api/reports/attendance (ФИО)": queries.user_names(),
+        "GET /api/sync (полный снимок)": queries.sync_rows(),
+        "GET /api/sync (изменения)": queries.sync_rows(1),
+        "GET /api/sync (удаления)": queries.sync_tombstones(1),
+        "Idempotency-Key (очистка)": queries.expired_keys(now),
+    }
+
+
+def query_plans(engine: Engine) -> dict:
+    """Строки EXPLAIN QUERY PLAN для каждого запроса эндпоинта."""
+    plans = {}
+    with engine.connect() as conn:
+        for name, stmt in endpoint_queries().items():
+            compiled = stmt.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+            params = tuple(compiled.params[key] for key in compiled.positiontup)
+            rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+            plans[name] = [row[-1] for row in rows]
+    return plans
+
+
+def _full_scan(step: str) -> bool:
+    return step.startswith("SCAN") and "INDEX" not in step
+
+
+def _is_sort(step: str) -> bool:
+    return "TEMP B-TREE" in step
+
+
+# Запросы, которым по смыслу нужна вся таблица (полный снимок, словарь ФИО)
+FULL_READS = {
+    "GET /api/absent?near=, /api/geofences/mismatches",
+    "GET /api/reports/attendance (ФИО)",
+    "GET /api/sync (полный снимок)",
+}
+
+
+def plan_problems(plans: dict) -> dict:
+    """
+    Шаги плана, которых быть не должно: полное сканирование таблицы
+    и сортировка во временном B-дереве там, где порядок должен давать индекс.
+    """
+    problems = {}
+    for name, steps in plans.items():
+        bad = [
+            step for step in steps
+            if (_full_scan(step) and name not in FULL_READS)
+            or (_is_sort(step) and name in ORDERED_BY_INDEX)
+        ]
+        if bad:
+            problems[name] = bad
+    return problems
+
+
+def check_query_plans() -> int:
+    """Проверка на временной БД с актуальной схемой; код возврата 1 при проблемах в планах."""
+    import os
+    import tempfile
+
+    from sqlalchemy import create_engine
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'plans.db')}")
+        upgrade(engine)
+        plans = query_plans(engine)
+        engine.dispose()
+
+    for name, steps in plans.items():
+        print(f"{name}:")
+        for step in steps:
+            print(f"    {step}")
+    bad = plan_problems(plans)
+    if bad:
+        print("\nЗапросы без нужного индекса:")
+        for name, steps in bad.items():
+            print(f"    {name}: {'; '.join(steps)}")
+        return 1
+    print("\nВсе запросы используют индексы")
+    return 0
+
+
+def main() -> None:
+    """Запуск миграций или проверки планов из командной строки."""
+    parser = argparse.ArgumentParser(description="Миграции схемы СКУД-лайт")
+    parser.add_argument("--check-plans", action="store_true", help="проверить планы запросов эндпоинтов")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    if args.check_plans:
+        sys.exit(check_query_plans())
+
+    from database import engine, setup_lock
+    with setup_lock():
+        applied = upgrade(engine)
+    print(f"Применено миграций: {len(applied)}" if applied else "Схема актуальна")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import enum
 import uuid as uuid_lib
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Float, Enum as SQLEnum
+from sqlalchemy import Column, Integer, String, DateTime, Float, Text, Index, Enum as SQLEnum, text
 
 from database import Base
 
@@ -14,6 +14,10 @@ class UserStatus(str, enum.Enum):
     request = "request"     # По заявлению
 
 
+# Статусы «вне здания» (для /api/absent)
+ABSENT_STATUSES = [status for status in UserStatus if status != UserStatus.inside]
+
+
 class User(Base):
     """Модель пользователя (жильца)."""
     __tablename__ = "users"
@@ -26,3 +30,89 @@ class User(Base):
     # Геолокация (последние известные координаты)
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
+    # Ревизии синхронизации (см. sync.py): последнего изменения и создания строки
+    rev = Column(Integer, nullable=False, default=0)
+    created_rev = Column(Integer, nullable=False, default=0)
+
+    # Индексы под запросы эндпоинтов (создаются миграциями, см. migrations.py)
+    __table_args__ = (
+        Index("ix_users_status_full_name", "status", "full_name"),
+        Index("ix_users_absent_full_name", "full_name", sqlite_where=text("status != 'inside'")),
+        Index("ix_users_full_name", "full_name"),
+        Index("ix_users_last_update", "last_update"),
+        Index("ix_users_rev", "rev"),
+    )
+
+
+class StatusEvent(Base):
+    """Смена статуса жильца (история переходов для отчётов)."""
+    __tablename__ = "status_events"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    old_status = Column(SQLEnum(UserStatus), nullable=True)  # None — регистрация
+    new_status = Column(SQLEnum(UserStatus), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Покрывающий индекс для выборки за период: отчёт читается без обращения к таблице
+        Index("ix_status_events_period", "created_at", "user_id", "new_status", "old_status"),
+        Index("ix_status_events_user", "user_id", "created_at"),
+    )
+
+
+class ArchivedUser(Base):
+    """Жилец в архиве (удалён или давно неактивен); можно восстановить."""
+    __tablename__ = "users_archive"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)  # id в таблице users на момент архивации
+    uuid = Column(String, nullable=False, index=True)
+    full_name = Column(String, nullable=False, index=True)
+    status = Column(SQLEnum(UserStatus))
+    last_update = Column(DateTime)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    reason = Column(String, nullable=False)  # deleted, inactive
+
+
+class ArchivedStatusEvent(Base):
+    """История переходов жильца из архива."""
+    __tablename__ = "status_events_archive"
+
+    id = Column(Integer, primary_key=True)
+    archive_id = Column(Integer, nullable=False, index=True)
+    old_status = Column(SQLEnum(UserStatus), nullable=True)
+    new_status = Column(SQLEnum(UserStatus), nullable=False)
+    created_at = Column(DateTime)
+
+
+class IdempotencyKey(Base):
+    """Ответ на запрос с заголовком Idempotency-Key (для повторов без двойной записи)."""
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(64), primary_key=True)
+    endpoint = Column(String, nullable=False)
+    request_hash = Column(String(64), nullable=True)  # SHA-256 тела; NULL у ключей старых версий
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class SyncState(Base):
+    """Счётчик ревизий синхронизации (одна строка)."""
+    __tablename__ = "sync_state"
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False)
+    min_rev = Column(Integer, nullable=False)  # дельта от более ранних ревизий невозможна
+
+
+class SyncTombstone(Base):
+    """Жилец, убранный из users (в архив), — чтобы клиенты удалили его из зеркала."""
+    __tablename__ = "sync_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    rev = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
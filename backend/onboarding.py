@@ -0,0 +1,403 @@
+"""
+Массовая регистрация жильцов по списку и персональные QR-коды.
+
+Вместо общего QR-кода и ручного ввода ФИО каждый жилец получает свою
+ссылку вида {base_url}/?uid=<uuid>: frontend сохраняет uuid и сразу
+показывает статус, минуя форму регистрации.
+
+    python onboarding.py roster.csv --base-url https://skud.example.ru
+
+roster.csv — ФИО в столбце full_name или в первом столбце (можно просто
+по одному ФИО на строку). Жильцы, уже зарегистрированные с тем же ФИО,
+не создаются повторно — для них используется существующий uuid.
+Необязательный столбец uuid (например, links.csv прошлого запуска)
+привязывает строку к конкретному жильцу. Однофамильцы с одинаковым ФИО
+без uuid не склеиваются: такой список отклоняется с перечнем ФИО.
+
+Результат в каталоге --out (по умолчанию qr/):
+    codes/<uuid>.png|svg — QR-код каждого жильца
+    sheets/sheet-NNNN.svg — листы A4 для печати (код + ФИО)
+    links.csv            — ФИО, uuid и ссылка (для рассылки)
+Коды и листы рисуются в пуле процессов; неизменившиеся не перерисовываются
+(ключи в manifest.json). Матрицы кодов хранятся в matrices.npz, поэтому
+перерисовка листов или смена формата не кодирует ссылки заново.
+
+Время: почти всё уходит на построение матрицы в segno (подбор маски по
+стандарту) — около 7 с на 1000 новых жильцов на одно ядро, то есть порядка
+минуты на 10 тыс. на ядро; --workers делит это время на число процессов.
+Повторные запуски кодируют только новых жильцов.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import numpy as np
+import segno
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import User, StatusEvent
+import sync
+
+# Параметры кода: коррекция M выдерживает потёртую печать, border — обязательная белая рамка
+QR_ERROR = "m"
+QR_SCALE = 8
+QR_BORDER = 4
+
+# Лист A4 (мм): сетка COLS x ROWS, под кодом — ФИО
+PAGE_W, PAGE_H = 210, 297
+COLS, ROWS = 4, 6
+CODE_MM = 38
+PER_SHEET = COLS * ROWS
+
+
+def normalize_name(name: str) -> str:
+    """ФИО без лишних пробелов — для сравнения с уже зарегистрированными."""
+    return re.sub(r"\s+", " ", name).strip()
+
+
+def read_roster(path: Path) -> list[tuple[str, str]]:
+    """
+    Строки списка: пары (ФИО, uuid или None) в исходном порядке, без пустых.
+
+    Повторы ФИО сохраняются — однофамильцев различает register_roster.
+    """
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return []
+    column, uuid_column = 0, None
+    header = [normalize_name(cell).lower() for cell in rows[0]]
+    if "full_name" in header:
+        column = header.index("full_name")
+        uuid_column = header.index("uuid") if "uuid" in header else None
+        rows = rows[1:]
+
+    entries, seen_uuids = [], set()
+    for row in rows:
+        name = normalize_name(row[column]) if len(row) > column else ""
+        uuid = None
+        if uuid_column is not None and len(row) > uuid_column:
+            uuid = row[uuid_column].strip() or None
+        if len(name) < 2 or uuid in seen_uuids:
+            continue
+        if uuid:
+            seen_uuids.add(uuid)
+        entries.append((name, uuid))
+    return entries
+
+
+def register_roster(db: Session, entries: list[tuple[str, str]]) -> tuple[list[tuple[str, str]], int]:
+    """
+    Регистрация жильцов из списка одной транзакцией (без коммита).
+
+    Строка с uuid относится к этому жильцу; строка без uuid — к единственному
+    жильцу с тем же ФИО (не занятому другой строкой) или регистрирует нового.
+    Если ФИО без uuid повторяется в списке или совпадает с несколькими
+    жильцами, сопоставить нельзя — ValueError с перечнем таких ФИО.
+
+    Возвращает пары (ФИО, uuid) для всего списка и число созданных.
+    """
+    by_name, known = {}, set()
+    for full_name, uuid in db.execute(select(User.full_name, User.uuid).order_by(User.id)):
+        by_name.setdefault(normalize_name(full_name), []).append(uuid)
+        known.add(uuid)
+
+    claimed = {uuid for _, uuid in entries if uuid}
+    unknown = sorted(claimed - known)
+    name_counts = {}
+    for name, uuid in entries:
+        if not uuid:
+            name_counts[name] = name_counts.get(name, 0) + 1
+
+    problems = [f"uuid не найден: {uuid}" for uuid in unknown]
+    matched = {}
+    for name, count in name_counts.items():
+        candidates = [uuid for uuid in by_name.get(name, []) if uuid not in claimed]
+        if count > 1:
+            problems.append(f"{name}: повторяется в списке {count} раз(а)")
+        elif len(candidates) > 1:
+            problems.append(f"{name}: зарегистрированных жильцов с таким ФИО — {len(candidates)}")
+        elif candidates:
+            matched[name] = candidates[0]
+    if problems:
+        raise ValueError(
+            "Строки списка нельзя однозначно сопоставить с жильцами:\n  " + "\n  ".join(problems)
+            + "\nОднофамильцев различает столбец uuid (см. links.csv) или уточнённое ФИО (например, с номером комнаты)."
+        )
+
+    new_names = [name for name in name_counts if name not in matched]
+    if new_names:
+        rev = sync.next_revision(db)
+        users = [User(full_name=name, rev=rev, created_rev=rev) for name in new_names]
+        db.add_all(users)
+        db.flush()
+        db.add_all(StatusEvent(user_id=u.id, old_status=None, new_status=u.status) for u in users)
+        matched.update((u.full_name, u.uuid) for u in users)
+
+    return [(name, uuid or matched[name]) for name, uuid in entries], len(new_names)
+
+
+def deep_link(base_url: str, uuid: str) -> str:
+    """Ссылка, по которой frontend сразу открывает статус жильца."""
+    return f"{base_url.rstrip('/')}/?uid={uuid}"
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:16]
+
+
+def code_key(link: str, kind: str) -> str:
+    """Ключ кэша кода: меняется вместе со ссылкой или параметрами рисования."""
+    return _digest(link, kind, QR_ERROR, QR_SCALE, QR_BORDER)
+
+
+def matrix_key(link: str) -> str:
+    """Ключ кэша матрицы: сама матрица зависит только от ссылки и уровня коррекции."""
+    return _digest(link, QR_ERROR)
+
+
+def sheet_key(entries: list[tuple[str, str]]) -> str:
+    """Ключ кэша листа: ФИО и ссылки на нём плюс раскладка."""
+    return _digest(QR_ERROR, PAGE_W, PAGE_H, COLS, ROWS, CODE_MM, *(part for entry in entries for part in entry))
+
+
+def qr_matrix(link: str) -> np.ndarray:
+    """Матрица кода без рамки (True — тёмный модуль); подбор маски — самая дорогая часть."""
+    return np.array(segno.make(link, error=QR_ERROR).matrix, dtype=bool)
+
+
+def load_matrices(path: Path) -> dict:
+    """Матрицы прошлых запусков по matrix_key."""
+    if not path.exists():
+        return {}
+    with np.load(path) as data:
+        keys, sizes, offsets, bits = data["keys"], data["sizes"], data["offsets"], data["bits"]
+    return {
+        str(key): np.unpackbits(bits[offsets[i]:offsets[i + 1]], count=size * size).astype(bool).reshape(size, size)
+        for i, (key, size) in enumerate(zip(keys, sizes.tolist()))
+    }
+
+
+def save_matrices(path: Path, matrices: dict) -> None:
+    """Матрицы одним файлом: ключи, размеры и упакованные биты подряд."""
+    packed = [np.packbits(matrix) for matrix in matrices.values()]
+    np.savez(
+        path,
+        keys=np.array(list(matrices), dtype="U16"),
+        sizes=np.array([len(matrix) for matrix in matrices.values()], dtype=np.int32),
+        offsets=np.cumsum([0] + [len(p) for p in packed]),
+        bits=np.concatenate(packed) if packed else np.empty(0, dtype=np.uint8),
+    )
+
+
+def svg_path(dark: np.ndarray) -> str:
+    """Тёмные модули отрезками по строкам — атрибут d для линии толщиной в модуль."""
+    edges = np.diff(np.pad(dark.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return "".join(f"M{x} {y}.5h{n}" for y, x, n in zip(rows.tolist(), starts.tolist(), (ends - starts).tolist()))
+
+
+def svg_inline(dark: np.ndarray, border: int = QR_BORDER) -> str:
+    """Код как SVG-фрагмент в координатах модулей (рамка входит в размер)."""
+    return f'<path transform="translate({border} {border})" stroke="#000" d="{svg_path(dark)}"/>'
+
+
+def svg_text(dark: np.ndarray, scale: int = QR_SCALE, border: int = QR_BORDER) -> str:
+    """Отдельный код в SVG на белом фоне."""
+    size = len(dark) + 2 * border
+    return (
+        f'<?xml version="1.0" encoding="utf-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * scale}" height="{size * scale}" '
+        f'viewBox="0 0 {size} {size}"><rect width="{size}" height="{size}" fill="#fff"/>{svg_inline(dark, border)}</svg>\n'
+    )
+
+
+def render_sheet(entries: list) -> str:
+    """Лист A4 в SVG: сетка кодов (пары ФИО, матрица) с ФИО под каждым."""
+    cell_w, cell_h = PAGE_W / COLS, PAGE_H / ROWS
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{PAGE_W}mm" height="{PAGE_H}mm" '
+        f'viewBox="0 0 {PAGE_W} {PAGE_H}" font-family="sans-serif">',
+        f'<rect width="{PAGE_W}" height="{PAGE_H}" fill="#fff"/>',
+    ]
+    for i, (name, dark) in enumerate(entries):
+        x = (i % COLS) * cell_w
+        y = (i // COLS) * cell_h
+        size = len(dark) + 2 * QR_BORDER
+        parts.append(
+            f'<svg x="{x + (cell_w - CODE_MM) / 2:.2f}" y="{y + 3:.2f}" width="{CODE_MM}" height="{CODE_MM}" '
+            f'viewBox="0 0 {size} {size}">{svg_inline(dark)}</svg>'
+        )
+        parts.append(
+            f'<text x="{x + cell_w / 2:.2f}" y="{y + CODE_MM + 7:.2f}" font-size="3.2" '
+            f'text-anchor="middle">{escape(name)}</text>'
+        )
+    parts.append("</svg>")
+    return "".join(parts)
+
+
+def png_bytes(dark: np.ndarray, scale: int = QR_SCALE, border: int = QR_BORDER) -> bytes:
+    """
+    Чёрно-белый PNG (1 бит на пиксель) из матрицы кода.
+
+    Масштабирование и упаковка — на NumPy: в разы быстрее построчной
+    записи segno.
+    """
+    pixels = np.repeat(np.repeat(np.pad(dark, border), scale, axis=0), scale, axis=1)
+    rows = np.packbits(~pixels, axis=1)  # 1 — белый
+    raw = np.hstack([np.zeros((rows.shape[0], 1), dtype=np.uint8), rows]).tobytes()  # фильтр None
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    height, width = pixels.shape
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw)),
+        chunk(b"IEND", b""),
+    ])
+
+
+def render_batch(task: dict) -> dict:
+    """
+    Задача для процесса пула: один лист и коды его жильцов.
+
+    Матрица берётся из кэша прошлых запусков или строится один раз
+    и идёт и в отдельный файл, и на лист. Возвращает новые матрицы по matrix_key.
+    """
+    built, entries = {}, []
+    for name, uuid, link, stale, dark in task["entries"]:
+        if dark is None:
+            dark = built[matrix_key(link)] = qr_matrix(link)
+        entries.append((name, dark))
+        if not stale:
+            continue
+        path = os.path.join(task["codes_dir"], f"{uuid}.{task['kind']}")
+        if task["kind"] == "png":
+            Path(path).write_bytes(png_bytes(dark))
+        else:
+            Path(path).write_text(svg_text(dark), encoding="utf-8")
+    if task["sheet_path"]:
+        Path(task["sheet_path"]).write_text(render_sheet(entries), encoding="utf-8")
+    return built
+
+
+def generate(residents: list[tuple[str, str]], base_url: str, out: Path, kind: str = "png", workers: int = None) -> dict:
+    """
+    Коды и листы для пар (ФИО, uuid) с кэшем на диске.
+
+    Возвращает число перерисованных кодов и листов.
+    """
+    codes_dir, sheets_dir = out / "codes", out / "sheets"
+    codes_dir.mkdir(parents=True, exist_ok=True)
+    sheets_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path, matrices_path = out / "manifest.json", out / "matrices.npz"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    old_codes, old_sheets = manifest.get("codes", {}), manifest.get("sheets", {})
+    # Матрицы не зависят от формата и раскладки: перерисовка листа или смена
+    # формата не требует заново кодировать ссылки
+    old_matrices = load_matrices(matrices_path)
+
+    # Листы в порядке списка (например, по комнатам): дописанные в конец
+    # жильцы меняют только последний лист, остальные берутся из кэша
+    links = [(name, uuid, deep_link(base_url, uuid)) for name, uuid in residents]
+
+    codes, stale_codes = {}, set()
+    for _, uuid, link in links:
+        codes[uuid] = code_key(link, kind)
+        if old_codes.get(uuid) != codes[uuid] or not (codes_dir / f"{uuid}.{kind}").exists():
+            stale_codes.add(uuid)
+
+    sheets, tasks = {}, []
+    for start in range(0, len(links), PER_SHEET):
+        sheet_links = links[start:start + PER_SHEET]
+        sheet_name = f"sheet-{start // PER_SHEET + 1:04d}.svg"
+        sheets[sheet_name] = sheet_key([(name, link) for name, _, link in sheet_links])
+        sheet_stale = old_sheets.get(sheet_name) != sheets[sheet_name] or not (sheets_dir / sheet_name).exists()
+        if not sheet_stale:
+            # Лист не изменился — в задачу идут только его устаревшие коды
+            sheet_links = [entry for entry in sheet_links if entry[1] in stale_codes]
+        if sheet_links:
+            tasks.append({
+                "entries": [
+                    (name, uuid, link, uuid in stale_codes, old_matrices.get(matrix_key(link)))
+                    for name, uuid, link in sheet_links
+                ],
+                "sheet_path": str(sheets_dir / sheet_name) if sheet_stale else None,
+                "codes_dir": str(codes_dir),
+                "kind": kind,
+            })
+    for sheet_name in set(old_sheets) - set(sheets):
+        (sheets_dir / sheet_name).unlink(missing_ok=True)
+    # Коды выбывших жильцов (в любом формате) удаляются, чтобы их не раздали вместе с актуальными;
+    # каталог просматривается целиком — на случай потерянного manifest.json
+    for path in [*codes_dir.glob("*.png"), *codes_dir.glob("*.svg")]:
+        if path.stem not in codes:
+            path.unlink(missing_ok=True)
+
+    if len(tasks) > 1 and workers != 1:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            built = list(pool.map(render_batch, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        built = [render_batch(task) for task in tasks]
+
+    with open(out / "links.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["full_name", "uuid", "link"])
+        writer.writerows(links)
+    for new in built:
+        old_matrices.update(new)
+    keep = {matrix_key(link) for _, _, link in links}
+    save_matrices(matrices_path, {key: m for key, m in old_matrices.items() if key in keep})
+    manifest_path.write_text(json.dumps({"codes": codes, "sheets": sheets}))
+    return {"codes": len(stale_codes), "sheets": sum(1 for task in tasks if task["sheet_path"])}
+
+
+def main() -> None:
+    """Запуск регистрации по списку из командной строки."""
+    from database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Регистрация жильцов по списку и QR-коды")
+    parser.add_argument("roster", type=Path, help="CSV со списком ФИО")
+    parser.add_argument("--base-url", default=os.getenv("PUBLIC_URL"), help="адрес сервера (или PUBLIC_URL)")
+    parser.add_argument("--out", type=Path, default=Path("qr"), help="каталог для кодов и листов")
+    parser.add_argument("--format", choices=["png", "svg"], default="png", help="формат отдельных кодов")
+    parser.add_argument("--workers", type=int, default=None, help="процессов для рисования")
+    args = parser.parse_args()
+    if not args.base_url:
+        parser.error("укажите --base-url или PUBLIC_URL")
+
+    entries = read_roster(args.roster)
+    init_db()
+    db = SessionLocal()
+    try:
+        residents, created = register_roster(db, entries)
+        db.commit()
+    except ValueError as e:
+        sys.exit(str(e))
+    finally:
+        db.close()
+
+    rendered = generate(residents, args.base_url, args.out, kind=args.format, workers=args.workers)
+    print(
+        f"Жильцов в списке: {len(residents)}, зарегистрировано новых: {created}; "
+        f"нарисовано кодов: {rendered['codes']}, листов: {rendered['sheets']} -> {args.out}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Запросы эндпоинтов к БД.
+
+Эндпоинты и проверка планов (python migrations.py --check-plans) строят
+запросы одними и теми же функциями, поэтому проверяется ровно то, что выполняется.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Integer, case, cast, delete, func, literal, select
+
+from models import User, UserStatus, StatusEvent, ArchivedUser, ArchivedStatusEvent, IdempotencyKey, SyncTombstone
+
+STATUSES = list(UserStatus)
+
+
+def status_code(column, else_=None):
+    """Код статуса (номер в UserStatus) вместо строки — для выборки колонками."""
+    return case({status: code for code, status in enumerate(STATUSES)}, value=column, else_=else_)
+
+
+# === Жильцы ===
+
+def user_by_uuid(user_uuid: str):
+    return select(User).where(User.uuid == user_uuid)
+
+
+def user_by_id(user_id: int):
+    return select(User).where(User.id == user_id)
+
+
+def status_counts():
+    return select(User.status, func.count(User.id)).group_by(User.status)
+
+
+def absent_users():
+    """Отсутствующие по ФИО: условие совпадает с частичным индексом ix_users_absent_full_name."""
+    # Значение подставляется в SQL литералом, иначе SQLite может не сопоставить частичный индекс
+    inside = literal(UserStatus.inside, User.status.type, literal_execute=True)
+    return select(User).where(User.status != inside).order_by(User.full_name)
+
+
+def users_by_name():
+    return select(User).order_by(User.full_name)
+
+
+def search_users(q: str, limit: int = 10):
+    return select(User).where(User.full_name.ilike(f"%{q}%")).order_by(User.full_name).limit(limit)
+
+
+def positions():
+    """Жильцы с известными координатами (снимок для геозапросов)."""
+    return select(User.full_name, User.status, User.latitude, User.longitude).where(
+        User.latitude.isnot(None), User.longitude.isnot(None)
+    )
+
+
+def user_names():
+    return select(User.id, User.full_name)
+
+
+# === Архив ===
+
+def inactive_users(cutoff: datetime, limit: int):
+    return select(User.id).where(User.last_update < cutoff).order_by(User.last_update).limit(limit)
+
+
+def user_history(archive_ids: list[int]):
+    """История уходящих в архив жильцов, привязанная к их архивным записям."""
+    return (
+        select(ArchivedUser.id, StatusEvent.old_status, StatusEvent.new_status, StatusEvent.created_at)
+        .join(ArchivedUser, ArchivedUser.user_id == StatusEvent.user_id)
+        .where(ArchivedUser.id.in_(archive_ids))
+        .order_by(StatusEvent.id)
+    )
+
+
+def archived_history(archive_id: int, user_id: int):
+    """История жильца из архива, переписанная на его id в users."""
+    return select(
+        literal(user_id, StatusEvent.user_id.type),
+        ArchivedStatusEvent.old_status,
+        ArchivedStatusEvent.new_status,
+        ArchivedStatusEvent.created_at,
+    ).where(ArchivedStatusEvent.archive_id == archive_id).order_by(ArchivedStatusEvent.id)
+
+
+def search_archive(q: str, limit: int = 10):
+    return (
+        select(ArchivedUser).where(ArchivedUser.full_name.ilike(f"%{q}%"))
+        .order_by(ArchivedUser.full_name).limit(limit)
+    )
+
+
+# === Отчёты ===
+
+def initial_statuses(start: datetime):
+    """Статус каждого жильца на начало периода: последний переход до start."""
+    last_before = (
+        select(func.max(StatusEvent.id))
+        .where(StatusEvent.created_at < start)
+        .group_by(StatusEvent.user_id)
+    )
+    return select(StatusEvent.user_id, status_code(StatusEvent.new_status)).where(StatusEvent.id.in_(last_before))
+
+
+def period_events(start: datetime, end: datetime):
+    """Переходы за период колонками [user_id, unix-время, статус, прежний статус]."""
+    return select(
+        StatusEvent.user_id,
+        cast(func.strftime("%s", StatusEvent.created_at), Integer),
+        status_code(StatusEvent.new_status),
+        status_code(StatusEvent.old_status, else_=-1),
+    ).where(
+        StatusEvent.created_at >= start, StatusEvent.created_at < end
+    ).order_by(StatusEvent.created_at)
+
+
+# === Синхронизация ===
+
+def sync_rows(since: int = None):
+    """Жильцы для /api/sync: все (since=None) или изменённые после ревизии since."""
+    query = select(User.id, User.status, User.latitude, User.longitude, User.created_rev, User.full_name)
+    if since is not None:
+        query = query.where(User.rev > since)
+    return query
+
+
+def sync_tombstones(since: int):
+    return select(SyncTombstone.user_id).where(SyncTombstone.rev > since)
+
+
+# === Idempotency-Key ===
+
+def expired_keys(cutoff: datetime):
+    return delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff)
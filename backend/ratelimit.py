@@ -0,0 +1,229 @@
+"""
+Ограничение нагрузки на запись: token bucket по uuid и IP + лимит одновременных записей.
+
+Лишние запросы сразу получают 429 с Retry-After, а не ждут в очереди
+к SQLite. Состояние корзин хранится в памяти процесса или, при нескольких
+воркерах, в общем локальном файле SQLite (RATE_LIMIT_STORE=путь/к/файлу.db).
+Повтор с уже сохранённым Idempotency-Key ничего не пишет и корзину uuid не тратит.
+
+Переменные окружения:
+    RATE_LIMIT_USER_RATE / RATE_LIMIT_USER_BURST — токенов в секунду и ёмкость на uuid
+    RATE_LIMIT_IP_RATE / RATE_LIMIT_IP_BURST     — то же на IP
+    MAX_CONCURRENT_WRITES                        — одновременных записей на воркер
+    RATE_LIMIT_STORE                             — memory (по умолчанию) или путь к файлу SQLite
+    RATE_LIMIT_PROXY_HOPS                        — число доверенных прокси перед приложением (0)
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, Request
+from sqlalchemy.orm import Session
+
+from database import get_db
+import idempotency
+
+USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", "0.1"))
+USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "5"))
+# Жильцы в здании часто выходят через один NAT, поэтому лимит на IP щедрее
+IP_RATE = float(os.getenv("RATE_LIMIT_IP_RATE", "5"))
+IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "60"))
+MAX_CONCURRENT_WRITES = int(os.getenv("MAX_CONCURRENT_WRITES", "8"))
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+# Каждый прокси дописывает в X-Forwarded-For адрес, с которого к нему пришли;
+# адрес клиента — запись, добавленная самым внешним из PROXY_HOPS доверенных прокси.
+# Записи левее подставляет сам клиент, им верить нельзя.
+PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+
+# Корзины, не тронутые дольше этого (секунды), удаляются — они всё равно полные
+IDLE_TTL = 3600
+EVICT_EVERY = 1000
+
+
+class MemoryStore:
+    """Корзины и счётчики в памяти процесса."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        """Взять токен: 0 — разрешено, иначе секунды до появления токена."""
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def incr(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def counters(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    def evict(self, before: float) -> None:
+        with self._lock:
+            for key in [k for k, (_, updated) in self._buckets.items() if updated < before]:
+                del self._buckets[key]
+
+
+class SQLiteStore:
+    """
+    Корзины и счётчики в отдельном файле SQLite, общем для всех воркеров.
+
+    Проверка корзины — один UPSERT: токен списывается, только если он есть.
+    Данные не критичны, поэтому synchronous=OFF.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Соединение на поток (открывается при первом обращении, уже после fork)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY, value INTEGER NOT NULL
+                ) WITHOUT ROWID;
+            """)
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        """Взять токен: 0 — разрешено, иначе секунды до появления токена."""
+        conn = self._connect()
+        row = conn.execute("""
+            INSERT INTO buckets (key, tokens, updated) VALUES (:key, :burst - 1, :now)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = min(:burst, tokens + (:now - updated) * :rate) - 1,
+                updated = :now
+            WHERE min(:burst, tokens + (:now - updated) * :rate) >= 1
+            RETURNING tokens
+        """, {"key": key, "burst": burst, "rate": rate, "now": now}).fetchone()
+        if row is not None:
+            return 0.0
+        tokens, updated = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        return (1 - min(burst, tokens + (now - updated) * rate)) / rate
+
+    def incr(self, name: str) -> None:
+        self._connect().execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def counters(self) -> dict:
+        return dict(self._connect().execute("SELECT name, value FROM counters").fetchall())
+
+    def evict(self, before: float) -> None:
+        self._connect().execute("DELETE FROM buckets WHERE updated < ?", (before,))
+
+
+store = MemoryStore() if RATE_LIMIT_STORE == "memory" else SQLiteStore(RATE_LIMIT_STORE)
+
+_write_slots = threading.BoundedSemaphore(MAX_CONCURRENT_WRITES)
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+_takes = 0
+
+
+def _reject(reason: str, retry_after: float, detail: str):
+    store.incr(f"rejected_{reason}")
+    raise HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def _check_bucket(key: str, rate: float, burst: float, reason: str) -> None:
+    global _takes
+    now = time.time()
+    wait = store.take(key, rate, burst, now)
+    _takes += 1
+    if _takes % EVICT_EVERY == 0:
+        store.evict(now - IDLE_TTL)
+    if wait > 0:
+        _reject(reason, wait, "Слишком много запросов, попробуйте позже")
+
+
+def client_ip(request: Request) -> str:
+    """Адрес клиента для корзины IP (с учётом PROXY_HOPS доверенных прокси)."""
+    if PROXY_HOPS > 0:
+        forwarded = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if forwarded:
+            return forwarded[-min(PROXY_HOPS, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+
+def write_guard(
+    request: Request,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    Dependency для эндпоинтов записи.
+
+    Проверяет корзины IP и uuid (если он есть в пути), затем занимает слот
+    записи; если свободных слотов нет — сразу 429. Повтор уже выполненного
+    запроса (Idempotency-Key сохранён) корзину uuid не тратит.
+    """
+    global _in_flight
+    _check_bucket(f"ip:{client_ip(request)}", IP_RATE, IP_BURST, "ip")
+    user_id = request.path_params.get("user_id")
+    if user_id is not None and not (idempotency_key and idempotency.is_stored(db, idempotency_key.strip())):
+        _check_bucket(f"user:{user_id}", USER_RATE, USER_BURST, "user")
+
+    if not _write_slots.acquire(blocking=False):
+        _reject("concurrency", 1, "Сервер перегружен, попробуйте позже")
+    store.incr("allowed")
+    with _in_flight_lock:
+        _in_flight += 1
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+        _write_slots.release()
+
+
+def metrics_text() -> str:
+    """Счётчики в текстовом формате Prometheus."""
+    counters = store.counters()
+    lines = [
+        "# HELP skud_write_requests_total Запросы на запись по решению ограничителя",
+        "# TYPE skud_write_requests_total counter",
+        f'skud_write_requests_total{{result="allowed"}} {counters.get("allowed", 0)}',
+    ]
+    for reason in ("ip", "user", "concurrency"):
+        lines.append(
+            f'skud_write_requests_total{{result="rejected",reason="{reason}"}} {counters.get(f"rejected_{reason}", 0)}'
+        )
+    lines += [
+        "# HELP skud_write_in_flight Записи, выполняемые сейчас (этот воркер)",
+        "# TYPE skud_write_in_flight gauge",
+        f'skud_write_in_flight{{pid="{os.getpid()}"}} {_in_flight}',
+        "# HELP skud_write_slots Лимит одновременных записей на воркер",
+        "# TYPE skud_write_slots gauge",
+        f"skud_write_slots {MAX_CONCURRENT_WRITES}",
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,181 @@
+"""
+Отчёты о присутствии по истории переходов (status_events).
+
+История читается из БД колонками (user_id, время, код статуса) без ORM-объектов,
+а длительности и кривые отсутствия считаются векторно на NumPy.
+"""
+
+from dataclasses import dataclass
+from itertools import chain
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import UserStatus
+import queries
+
+STATUSES = list(UserStatus)
+INSIDE = STATUSES.index(UserStatus.inside)
+
+# Сколько строк забирать из курсора за раз
+FETCH_CHUNK = 100_000
+
+
+@dataclass
+class AttendanceReport:
+    """Результат расчёта: колонки по жильцам и кривая отсутствия."""
+    start: int
+    end: int
+    user_ids: np.ndarray       # (U,)
+    seconds: np.ndarray        # (U, len(STATUSES)) — секунды в каждом статусе
+    bucket_starts: np.ndarray  # (B,) — начало интервала, unix-время
+    avg_absent: np.ndarray     # (B,) — среднее число отсутствующих в интервале
+    by_hour: np.ndarray        # (24,) — среднее число отсутствующих по часу суток
+    peak_absent: int
+    peak_at: int
+
+    @property
+    def absent_seconds(self) -> np.ndarray:
+        return self.seconds.sum(axis=1) - self.seconds[:, INSIDE]
+
+
+def month_period(month: str, utc_offset: int = 0) -> tuple[datetime, datetime]:
+    """Границы месяца 'YYYY-MM' в местном времени, переведённые в UTC."""
+    start = datetime.strptime(month, "%Y-%m")
+    end = (start + timedelta(days=32)).replace(day=1)
+    offset = timedelta(hours=utc_offset)
+    return start - offset, end - offset
+
+
+def _fetch_columns(db: Session, stmt, ncols: int) -> np.ndarray:
+    """Результат запроса целыми числами в массив (N, ncols) по частям."""
+    # Core-соединение в обход ORM: строки сразу разворачиваются в плоский массив
+    result = db.connection().execute(stmt)
+    chunks = [
+        np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * ncols).reshape(-1, ncols)
+        for rows in result.partitions(FETCH_CHUNK)
+    ]
+    return np.concatenate(chunks) if chunks else np.empty((0, ncols), dtype=np.int64)
+
+
+def load_transitions(db: Session, start: datetime, end: datetime):
+    """
+    Переходы за период и статус каждого жильца на его начало.
+
+    Возвращает (начальные состояния [user_id, status], события [user_id, ts, status, old_status]);
+    события упорядочены по времени, группировка по жильцам — в compute_attendance.
+    """
+    initial = _fetch_columns(db, queries.initial_statuses(start), 2)
+    events = _fetch_columns(db, queries.period_events(start, end), 4)
+    return initial, events
+
+
+def _absent_area(starts: np.ndarray, ends: np.ndarray):
+    """
+    Ступенчатая функция «число отсутствующих» по интервалам отсутствия.
+
+    Возвращает (точки изменения, значение после точки, накопленную площадь до точки).
+    """
+    t = np.concatenate([starts, ends])
+    d = np.concatenate([np.ones(len(starts), np.int64), -np.ones(len(ends), np.int64)])
+    # При равном времени сначала уходы (-1), чтобы не завышать пик
+    order = np.lexsort((d, t))
+    t, d = t[order], d[order]
+    count = np.cumsum(d)
+    area = np.concatenate([[0], np.cumsum(count[:-1] * np.diff(t))]).astype(np.float64)
+    return t, count, area
+
+
+def _integral(t, count, area, x):
+    """Площадь под ступенчатой функцией от -inf до x (векторно по x)."""
+    if len(t) == 0:
+        return np.zeros(len(x))
+    idx = np.searchsorted(t, x, side="right") - 1
+    safe = np.clip(idx, 0, None)
+    return np.where(idx < 0, 0.0, area[safe] + count[safe] * (x - t[safe]))
+
+
+def compute_attendance(initial: np.ndarray, events: np.ndarray, start: int, end: int,
+                       bucket: int = 3600, utc_offset: int = 0) -> AttendanceReport:
+    """Длительности по статусам и кривая отсутствия за период [start, end)."""
+    if len(events):
+        # Группировка по жильцам с сохранением порядка по времени
+        events = events[np.argsort(events[:, 0], kind="stable")]
+    ev_users, ev_ts, ev_status, ev_old = events.T if len(events) else (np.empty(0, np.int64),) * 4
+
+    # Жильцы без перехода до начала периода: статус на начало — old_status первого события
+    first = np.unique(ev_users, return_index=True)[1]
+    missing = ~np.isin(ev_users[first], initial[:, 0]) & (ev_old[first] >= 0)
+    pre = first[missing]
+
+    users = np.concatenate([initial[:, 0], ev_users[pre], ev_users])
+    ts = np.concatenate([np.full(len(initial) + len(pre), start, np.int64), ev_ts])
+    status = np.concatenate([initial[:, 1], ev_old[pre], ev_status])
+
+    # Сортировка по (жилец, время); начальные состояния идут раньше событий в start
+    order = np.lexsort((np.arange(len(users)), ts, users))
+    users, ts, status = users[order], np.clip(ts[order], start, end), status[order]
+
+    # Каждое состояние длится до следующего события того же жильца (или до конца периода)
+    following = np.full(len(ts), end, np.int64)
+    same_user = users[:-1] == users[1:]
+    following[:-1][same_user] = ts[1:][same_user]
+    duration = following - ts
+
+    user_ids, inverse = np.unique(users, return_inverse=True)
+    n_status = len(STATUSES)
+    seconds = np.bincount(
+        inverse * n_status + status, weights=duration, minlength=len(user_ids) * n_status
+    ).reshape(len(user_ids), n_status)
+
+    absent = (status != INSIDE) & (duration > 0)
+    t, count, area = _absent_area(ts[absent], following[absent])
+
+    edges = np.append(np.arange(start, end, bucket), end)
+    avg_absent = np.diff(_integral(t, count, area, edges)) / np.diff(edges)
+
+    # Профиль по часу суток (местное время)
+    offset = utc_offset * 3600
+    first_hour = (start + offset) // 3600 * 3600 - offset
+    hour_edges = np.clip(np.arange(first_hour, end + 3600, 3600), start, end)
+    widths = np.diff(hour_edges)
+    hourly = np.divide(np.diff(_integral(t, count, area, hour_edges)), widths,
+                       out=np.zeros(len(widths)), where=widths > 0)
+    hour_of_day = ((hour_edges[:-1] + offset) // 3600) % 24
+    samples = np.bincount(hour_of_day, weights=widths > 0, minlength=24)
+    by_hour = np.divide(np.bincount(hour_of_day, weights=hourly, minlength=24), samples,
+                        out=np.zeros(24), where=samples > 0)
+
+    peak = int(count.argmax()) if len(count) else -1
+    return AttendanceReport(
+        start=start,
+        end=end,
+        user_ids=user_ids,
+        seconds=seconds,
+        bucket_starts=edges[:-1],
+        avg_absent=avg_absent,
+        by_hour=by_hour,
+        peak_absent=int(count[peak]) if peak >= 0 else 0,
+        peak_at=int(t[peak]) if peak >= 0 else start,
+    )
+
+
+def attendance_report(db: Session, start: datetime, end: datetime,
+                      bucket: int = 3600, utc_offset: int = 0) -> AttendanceReport:
+    """Отчёт о присутствии за период (конец не позже текущего момента)."""
+    end = max(start, min(end, datetime.utcnow()))
+    initial, events = load_transitions(db, start, end)
+    epoch = datetime(1970, 1, 1)
+    return compute_attendance(
+        initial, events,
+        start=int((start - epoch).total_seconds()),
+        end=int((end - epoch).total_seconds()),
+        bucket=bucket,
+        utc_offset=utc_offset,
+    )
+
+
+def user_names(db: Session) -> dict[int, str]:
+    """ФИО всех жильцов по id (только нужные колонки)."""
+    return dict(db.execute(queries.user_names()).tuples().all())
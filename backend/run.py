@@ -0,0 +1,80 @@
+"""
+Production-запуск API: gunicorn с N воркерами uvicorn.
+
+Схема БД настраивается один раз в главном процессе (под файловой блокировкой),
+затем приложение форкается в воркеры. По SIGTERM воркер сразу отвечает 503
+на /api/ready, ещё SHUTDOWN_DELAY секунд обслуживает запросы, затем перестаёт
+принимать соединения и дожидается текущих запросов (всего не дольше GRACEFUL_TIMEOUT).
+
+Переменные окружения:
+    PORT             — порт (по умолчанию 8000)
+    WEB_CONCURRENCY  — число воркеров (по умолчанию 2)
+    SHUTDOWN_DELAY   — сколько секунд после SIGTERM отвечать 503 до остановки (5 с)
+    GRACEFUL_TIMEOUT — сколько всего ждать воркер при остановке (30 с)
+
+При нескольких воркерах лимиты запросов хранятся в общем ratelimit.db
+(см. ratelimit.py), если RATE_LIMIT_STORE не задан явно.
+"""
+
+import time
+
+_started = time.perf_counter()
+
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger("skud")
+
+
+class Server(BaseApplication):
+    """gunicorn с уже загруженным приложением (без повторного импорта в воркерах)."""
+
+    def __init__(self, app, options: dict):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def main() -> None:
+    """Настройка схемы и запуск воркеров."""
+    workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+    if workers > 1:
+        # Лимиты запросов должны быть общими для всех воркеров
+        os.environ.setdefault("RATE_LIMIT_STORE", "ratelimit.db")
+
+    import main as api
+    from database import engine, init_db
+
+    imported = time.perf_counter()
+    init_db()
+    # Соединения главного процесса не должны достаться воркерам после fork
+    engine.dispose()
+    ready = time.perf_counter()
+
+    logger.info(
+        "Холодный старт: импорт %.0f мс, настройка схемы %.0f мс, всего %.0f мс",
+        (imported - _started) * 1000, (ready - imported) * 1000, (ready - _started) * 1000,
+    )
+
+    Server(api.app, {
+        "bind": f"0.0.0.0:{os.getenv('PORT', '8000')}",
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+        "timeout": 60,
+        "preload_app": True,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
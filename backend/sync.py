@@ -0,0 +1,113 @@
+"""
+Компактная синхронизация списка жильцов для бота и дашбордов.
+
+Каждая запись в users получает номер ревизии из общего счётчика (sync_state),
+а уход жильца в архив оставляет «надгробие» (sync_tombstones). Клиент хранит
+зеркало и последнюю ревизию и запрашивает только изменения после неё.
+
+Ответ — MessagePack со столбцами:
+    v        — версия формата
+    rev      — ревизия, до которой клиент теперь актуален
+    full     — True: заменить зеркало целиком
+    statuses — коды статусов (только при full)
+    ids, st, lat, lon — изменённые жильцы: id, код статуса, координаты (float32 или None)
+    nid, names        — словарь ФИО только для новых для клиента жильцов
+    del      — id удалённых (только при дельте)
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import msgpack
+from sqlalchemy import delete, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from models import User, UserStatus, SyncState, SyncTombstone
+import queries
+
+FORMAT_VERSION = 1
+STATUSES = list(UserStatus)
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+MEDIA_TYPE = "application/msgpack"
+
+# Сколько дней хранить надгробия; клиент, отставший сильнее, получит полный снимок
+TOMBSTONE_TTL_DAYS = int(os.getenv("SYNC_TOMBSTONE_TTL_DAYS", "30"))
+
+
+def next_revision(db: Session) -> int:
+    """Новая ревизия в текущей транзакции (счётчик виден другим только после коммита)."""
+    return db.execute(
+        update(SyncState).where(SyncState.id == 1)
+        .values(revision=SyncState.revision + 1)
+        .returning(SyncState.revision)
+    ).scalar_one()
+
+
+def current_revision(db: Session) -> int:
+    """Последняя закоммиченная ревизия."""
+    return db.execute(select(SyncState.revision).where(SyncState.id == 1)).scalar_one()
+
+
+def add_tombstones(db: Session, user_ids: list[int], rev: int) -> None:
+    """Отметить жильцов удалёнными для клиентов синхронизации."""
+    db.execute(insert(SyncTombstone).from_select(
+        ["rev", "user_id", "created_at"],
+        select(
+            literal(rev, SyncTombstone.rev.type),
+            User.id,
+            literal(datetime.utcnow(), SyncTombstone.created_at.type),
+        ).where(User.id.in_(user_ids))
+    ))
+
+
+def prune_tombstones(db: Session, days: int = TOMBSTONE_TTL_DAYS) -> int:
+    """Удаление старых надгробий; дельты от более ранних ревизий больше не выдаются."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    pruned_rev = db.execute(
+        select(SyncTombstone.rev).where(SyncTombstone.created_at < cutoff)
+        .order_by(SyncTombstone.rev.desc()).limit(1)
+    ).scalar()
+    if pruned_rev is None:
+        return 0
+    removed = db.execute(delete(SyncTombstone).where(SyncTombstone.rev <= pruned_rev)).rowcount
+    db.execute(update(SyncState).where(SyncState.id == 1).values(min_rev=pruned_rev))
+    return removed
+
+
+def build_delta(db: Session, since: int) -> dict:
+    """Изменения после ревизии since (или полный снимок, если дельта невозможна)."""
+    # Сначала ревизия, потом строки: всё, что не позже rev, уже закоммичено.
+    # Строки новее rev тоже могут попасть — клиент просто получит их повторно.
+    rev, min_rev = db.execute(select(SyncState.revision, SyncState.min_rev).where(SyncState.id == 1)).one()
+    full = since <= 0 or since < min_rev or since > rev
+
+    rows = db.execute(queries.sync_rows(None if full else since)).all()
+
+    payload = {
+        "v": FORMAT_VERSION,
+        "rev": rev,
+        "full": full,
+        "ids": [r[0] for r in rows],
+        "st": [STATUS_CODES[r[1]] for r in rows],
+        "lat": [r[2] for r in rows],
+        "lon": [r[3] for r in rows],
+    }
+    new_rows = rows if full else [r for r in rows if r[4] > since]
+    payload["nid"] = [r[0] for r in new_rows]
+    payload["names"] = [r[5] for r in new_rows]
+
+    if full:
+        payload["statuses"] = [status.value for status in STATUSES]
+    else:
+        # Жилец мог быть удалён и восстановлен с тем же id — тогда он уже в ids
+        changed = set(payload["ids"])
+        payload["del"] = [
+            user_id for user_id in db.execute(queries.sync_tombstones(since)).scalars().unique()
+            if user_id not in changed
+        ]
+    return payload
+
+
+def pack(payload: dict) -> bytes:
+    """MessagePack; координаты как float32 (точность около метра)."""
+    return msgpack.packb(payload, use_single_float=True)
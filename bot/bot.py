@@ -5,8 +5,10 @@ Telegram бот для дежурного (СКУД-лайт)
 """
 
 import os
+import asyncio
 import logging
 import httpx
+import msgpack
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
@@ -37,6 +39,72 @@ STATUS_LABELS = {
 }
 
 
+class ResidentMirror:
+    """
+    Локальная копия списка жильцов, обновляемая дельтами из /api/sync.
+
+    Хранит id -> [ФИО, статус, широта, долгота] и ревизию, до которой копия
+    актуальна; экраны сводки и списков строятся из неё без запросов JSON.
+    """
+
+    def __init__(self):
+        self.rev = 0
+        self.statuses = []
+        self.residents = {}
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> None:
+        """Догрузить изменения с сервера (при пустой копии — полный снимок)."""
+        async with self._lock:
+            async with httpx.AsyncClient() as client:
+                response = await client.get(f"{API_URL}/api/sync", params={"since": self.rev})
+                response.raise_for_status()
+            self.apply(msgpack.unpackb(response.content))
+
+    def apply(self, delta: dict) -> None:
+        """Применить ответ /api/sync к копии."""
+        if delta["full"]:
+            self.statuses = delta["statuses"]
+            self.residents = {}
+        names = dict(zip(delta["nid"], delta["names"]))
+        for user_id, code, lat, lon in zip(delta["ids"], delta["st"], delta["lat"], delta["lon"]):
+            name = names.get(user_id)
+            if name is None:
+                name = self.residents[user_id][0] if user_id in self.residents else ""
+            self.residents[user_id] = [name, self.statuses[code], lat, lon]
+        for user_id in delta.get("del", []):
+            self.residents.pop(user_id, None)
+        self.rev = delta["rev"]
+
+    def stats(self) -> dict:
+        """Количество жильцов по статусам."""
+        result = {status: 0 for status in STATUS_LABELS}
+        for _, status, _, _ in self.residents.values():
+            result[status] = result.get(status, 0) + 1
+        return result
+
+    def absent(self) -> list[dict]:
+        """Отсутствующие (все кроме inside), по ФИО."""
+        return sorted(
+            (
+                {
+                    "full_name": name,
+                    "status": status,
+                    "status_label": STATUS_LABELS.get(status, status),
+                    "latitude": lat,
+                    "longitude": lon,
+                    "has_location": lat is not None and lon is not None,
+                }
+                for name, status, lat, lon in self.residents.values()
+                if status != "inside"
+            ),
+            key=lambda user: user["full_name"],
+        )
+
+
+mirror = ResidentMirror()
+
+
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь администратором."""
     if not ADMIN_IDS:
@@ -90,10 +158,8 @@ async def check_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{API_URL}/api/stats")
-            response.raise_for_status()
-            stats = response.json()
+        await mirror.refresh()
+        stats = mirror.stats()
     except Exception as e:
         logger.error(f"Ошибка API: {e}")
         text = "❌ Ошибка связи с сервером"
@@ -107,7 +173,7 @@ async def check_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     work = stats.get("work", 0)
     day_off = stats.get("day_off", 0)
     request = stats.get("request", 0)
-    total = stats.get("total", 0)
+    total = sum(stats.values())
     absent_total = work + day_off + request
     
     text = (
@@ -138,10 +204,8 @@ async def absent_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{API_URL}/api/absent")
-            response.raise_for_status()
-            absent = response.json()
+        await mirror.refresh()
+        absent = mirror.absent()
     except Exception as e:
         logger.error(f"Ошибка API: {e}")
         text = "❌ Ошибка связи с сервером"
@@ -181,10 +245,8 @@ async def show_locations(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{API_URL}/api/absent")
-            response.raise_for_status()
-            absent = response.json()
+        await mirror.refresh()
+        absent = mirror.absent()
     except Exception as e:
         logger.error(f"Ошибка API: {e}")
         text = "❌ Ошибка связи с сервером"
@@ -328,7 +390,7 @@ async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.edit_message_text(
         "⚠️ *Вы уверены?*\n\n"
         "Пользователь будет удалён из системы.\n"
-        "Это действие нельзя отменить!",
+        "Запись и история сохранятся в архиве — её можно восстановить.",
         parse_mode="Markdown",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
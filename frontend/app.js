@@ -7,6 +7,9 @@
 // API на том же сервере (FastAPI раздаёт frontend)
 const API_URL = window.location.origin;
 const STORAGE_KEY = 'skud_user_id';
+const SUBMIT_KEY_STORAGE = 'skud_submit_key';
+// Сколько сохранённый ключ годится для повторов; позже нажатие — новое действие
+const SUBMIT_TTL_MS = 10 * 60 * 1000;
 
 // === DOM элементы ===
 const screens = {
@@ -76,6 +79,37 @@ function setUserId(userId) {
     localStorage.setItem(STORAGE_KEY, userId);
 }
 
+// === Idempotency-Key ===
+// Повторные нажатия для одного и того же действия отправляют тот же ключ
+// и то же тело (сервер отклоняет ключ с другим телом), поэтому действие
+// выполняется только один раз. Ключ забывается после ответа сервера
+// (в том числе на отметку из очереди) или через SUBMIT_TTL_MS
+
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+function getSubmit(action, body) {
+    const saved = JSON.parse(localStorage.getItem(SUBMIT_KEY_STORAGE) || 'null');
+    if (saved && saved.action === action && saved.body && Date.now() - saved.createdAt < SUBMIT_TTL_MS) {
+        return saved;
+    }
+    const submit = { action, key: newIdempotencyKey(), body: JSON.stringify(body), createdAt: Date.now() };
+    localStorage.setItem(SUBMIT_KEY_STORAGE, JSON.stringify(submit));
+    return submit;
+}
+
+function clearSubmitKey(key = null) {
+    if (key) {
+        const saved = JSON.parse(localStorage.getItem(SUBMIT_KEY_STORAGE) || 'null');
+        if (!saved || saved.key !== key) return;
+    }
+    localStorage.removeItem(SUBMIT_KEY_STORAGE);
+}
+
 // === Геолокация ===
 
 function getCurrentPosition() {
@@ -110,11 +144,11 @@ function getCurrentPosition() {
 async function apiRequest(endpoint, options = {}) {
     try {
         const response = await fetch(`${API_URL}${endpoint}`, {
+            ...options,
             headers: {
                 'Content-Type': 'application/json',
                 ...options.headers
-            },
-            ...options
+            }
         });
 
         if (!response.ok) {
@@ -132,9 +166,11 @@ async function apiRequest(endpoint, options = {}) {
 }
 
 async function register(fullName) {
+    const submit = getSubmit(`register:${fullName}`, { full_name: fullName });
     return await apiRequest('/api/register', {
         method: 'POST',
-        body: JSON.stringify({ full_name: fullName })
+        headers: { 'Idempotency-Key': submit.key },
+        body: submit.body
     });
 }
 
@@ -148,9 +184,12 @@ async function updateStatus(userId, status, location = null) {
         body.latitude = location.latitude;
         body.longitude = location.longitude;
     }
+    // Повтор отправляет координаты первой попытки, а не новые
+    const submit = getSubmit(`status:${userId}:${status}`, body);
     return await apiRequest(`/api/status/${userId}`, {
         method: 'POST',
-        body: JSON.stringify(body)
+        headers: { 'Idempotency-Key': submit.key },
+        body: submit.body
     });
 }
 
@@ -193,6 +232,7 @@ async function handleRegister(event) {
     showLoading();
     try {
         const data = await register(fullName);
+        clearSubmitKey();
         setUserId(data.user_id);
         updateMainScreen(data);
         showScreen('main');
@@ -214,8 +254,16 @@ async function handleStatusChange(event) {
     try {
         // Получаем геолокацию параллельно (не блокируем, если недоступна)
         const location = await getCurrentPosition();
-        await updateStatus(userId, newStatus, location);
+        const data = await updateStatus(userId, newStatus, location);
         showConfirmation(newStatus);
+        if (data.queued) {
+            // Service Worker сохранил отметку и отправит её сам; ключ забудется, когда он сообщит о доставке
+            showError(data.offline
+                ? 'Нет связи — отметка будет отправлена автоматически'
+                : 'Сервер занят — отметка будет отправлена автоматически');
+        } else {
+            clearSubmitKey();
+        }
     } catch (error) {
         showError(error.message);
     } finally {
@@ -238,9 +286,47 @@ async function handleBack() {
     }
 }
 
+// === Service Worker (очередь отметок без связи) ===
+
+function flushOutbox() {
+    if (navigator.serviceWorker && navigator.serviceWorker.controller) {
+        navigator.serviceWorker.controller.postMessage('flush-outbox');
+    }
+}
+
+function registerServiceWorker() {
+    if (!('serviceWorker' in navigator)) return;
+    // Отметка из очереди доставлена (или отброшена сервером) — её ключ больше не нужен
+    navigator.serviceWorker.addEventListener('message', (event) => {
+        if (event.data && event.data.sent) {
+            clearSubmitKey(event.data.sent);
+        }
+    });
+    navigator.serviceWorker.register('/sw.js')
+        .then(() => flushOutbox())
+        .catch(error => console.log('Service Worker недоступен:', error.message));
+    window.addEventListener('online', flushOutbox);
+}
+
 // === Инициализация ===
 
+/**
+ * Персональная ссылка из QR-кода (?uid=<uuid>): сохранить uuid
+ * и убрать его из адресной строки, чтобы не попал в закладки.
+ */
+function takeUserIdFromLink() {
+    const params = new URLSearchParams(window.location.search);
+    const linkedId = params.get('uid');
+    if (!linkedId) return;
+
+    setUserId(linkedId);
+    params.delete('uid');
+    const query = params.toString();
+    window.history.replaceState(null, '', window.location.pathname + (query ? `?${query}` : '') + window.location.hash);
+}
+
 async function init() {
+    takeUserIdFromLink();
     const userId = getUserId();
 
     if (!userId) {
@@ -276,4 +362,5 @@ elements.returnButton.addEventListener('click', handleStatusChange);
 elements.backBtn.addEventListener('click', handleBack);
 
 // Запуск приложения
+registerServiceWorker();
 init();
@@ -0,0 +1,179 @@
+/**
+ * СКУД-лайт Service Worker
+ * Очередь (outbox) отметок статуса, сделанных без связи с сервером
+ */
+
+const DB_NAME = 'skud_outbox';
+const STORE_NAME = 'requests';
+const SYNC_TAG = 'skud-outbox';
+
+// Экспоненциальная задержка повторов: 2с, 4с, 8с ... но не больше 5 минут
+const RETRY_BASE_MS = 2000;
+const RETRY_MAX_MS = 5 * 60 * 1000;
+
+let retryAttempt = 0;
+let retryTimer = null;
+let flushing = null;
+// Почему очередь не отправилась в последний раз: 'network' — нет связи, 'server' — 5xx/429
+let lastFailure = null;
+
+// === IndexedDB ===
+
+function openDb() {
+    return new Promise((resolve, reject) => {
+        const request = indexedDB.open(DB_NAME, 1);
+        request.onupgradeneeded = () => {
+            request.result.createObjectStore(STORE_NAME, { keyPath: 'id', autoIncrement: true });
+        };
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+async function withStore(mode, action) {
+    const db = await openDb();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction(STORE_NAME, mode);
+        const request = action(tx.objectStore(STORE_NAME));
+        tx.oncomplete = () => {
+            db.close();
+            resolve(request.result);
+        };
+        tx.onerror = () => {
+            db.close();
+            reject(tx.error);
+        };
+    });
+}
+
+const outboxAdd = (entry) => withStore('readwrite', store => store.add(entry));
+const outboxAll = () => withStore('readonly', store => store.getAll());
+const outboxDelete = (id) => withStore('readwrite', store => store.delete(id));
+
+// === Отправка и очередь ===
+
+async function sendOrQueue(request) {
+    const entry = {
+        url: request.url,
+        body: await request.clone().text(),
+        idempotencyKey: request.headers.get('Idempotency-Key'),
+        createdAt: Date.now()
+    };
+
+    // Сначала отправляем накопленную очередь: новая отметка не должна обогнать старые.
+    // Если очередь ушла — отправляем сразу, в очередь только при реальной ошибке.
+    const pending = await outboxAll();
+    if (pending.length === 0 || await flushOutbox()) {
+        try {
+            return await fetch(request);
+        } catch (error) {
+            lastFailure = 'network';
+        }
+    }
+
+    await outboxAdd(entry);
+    if (self.registration.sync) {
+        await self.registration.sync.register(SYNC_TAG).catch(() => {});
+    }
+    flushOutbox();
+
+    // offline: false — связь есть, но сервер пока не принимает (5xx/429)
+    return new Response(JSON.stringify({ queued: true, offline: lastFailure !== 'server' }), {
+        status: 202,
+        headers: { 'Content-Type': 'application/json' }
+    });
+}
+
+// Страница забывает сохранённый ключ, когда отметка с ним доставлена или отброшена
+async function notifyClients(message) {
+    const clients = await self.clients.matchAll({ type: 'window', includeUncontrolled: true });
+    clients.forEach(client => client.postMessage(message));
+}
+
+async function replayOutbox() {
+    const entries = await outboxAll();
+    for (const entry of entries) {
+        const headers = { 'Content-Type': 'application/json' };
+        if (entry.idempotencyKey) {
+            headers['Idempotency-Key'] = entry.idempotencyKey;
+        }
+
+        let response;
+        try {
+            response = await fetch(entry.url, { method: 'POST', headers, body: entry.body });
+        } catch (error) {
+            lastFailure = 'network';
+            return false;
+        }
+
+        // 5xx и 429 — временные, повторим позже; остальное удаляем из очереди
+        if (response.status >= 500 || response.status === 429) {
+            lastFailure = 'server';
+            return false;
+        }
+        await outboxDelete(entry.id);
+        await notifyClients({ sent: entry.idempotencyKey, status: response.status });
+    }
+    lastFailure = null;
+    return true;
+}
+
+function flushOutbox() {
+    if (!flushing) {
+        flushing = replayOutbox()
+            .catch(() => false)
+            .then((done) => {
+                flushing = null;
+                if (done) {
+                    retryAttempt = 0;
+                } else {
+                    scheduleRetry();
+                }
+                return done;
+            });
+    }
+    return flushing;
+}
+
+function scheduleRetry() {
+    if (retryTimer) return;
+    const delay = Math.min(RETRY_BASE_MS * 2 ** retryAttempt, RETRY_MAX_MS);
+    retryAttempt += 1;
+    // Случайный разброс, чтобы клиенты не возвращались одновременно
+    retryTimer = setTimeout(() => {
+        retryTimer = null;
+        flushOutbox();
+    }, delay / 2 + Math.random() * delay / 2);
+}
+
+// === События ===
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(self.clients.claim());
+});
+
+self.addEventListener('fetch', (event) => {
+    const { request } = event;
+    const url = new URL(request.url);
+    if (request.method === 'POST' && url.pathname.startsWith('/api/status/')) {
+        event.respondWith(sendOrQueue(request));
+    }
+});
+
+// Background Sync (где поддерживается): браузер сам повторит при ошибке
+self.addEventListener('sync', (event) => {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(flushOutbox().then((done) => {
+            if (!done) throw new Error('Очередь не отправлена');
+        }));
+    }
+});
+
+// Страница просит отправить очередь (загрузка, появление сети)
+self.addEventListener('message', (event) => {
+    if (event.data === 'flush-outbox') {
+        event.waitUntil(flushOutbox());
+    }
+});